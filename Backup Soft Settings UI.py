@@ -14,10 +14,13 @@ from tkinter import filedialog
 from tkinter.font import Font, families
 from tkinter.colorchooser import askcolor
 
+from main import parse_config
+
 ACTION_TYPES: dict = {
     "archive": 'Archive',
     "archive_and_del": 'Archive & delete',
-    "sync": 'Synchronize'
+    "sync": 'Synchronize',
+    "dedup": 'Deduplicated backup'
 }
 INV_ACTION_TYPES: dict = dict(
     (v, k) for k, v in ACTION_TYPES.items()
@@ -848,6 +851,9 @@ class Root:
 
                 format_: str = tuple(time_settings.keys())[0]
                 time_string: str = tuple(time_settings.values())[0]
+                if format_ == 'cron':
+                    # Cron and interval schedules are edited in the config file
+                    format_, time_string = '', ''
                 year, month, day, hour, minute, sec, _, _, _ = strptime(time_string, format_)
 
                 for (f, var), val in zip(self.time_variables.items(), (day, float(month), year, hour, minute, sec)):
@@ -966,7 +972,7 @@ class Root:
             }
         }
 
-        if json_action_type in tuple(ACTION_TYPES)[:-1]:
+        if json_action_type != 'sync':
             action[json_action_type]["setup"] = {
                 "from_path": 'PATH',
                 "to_path": 'PATH'
@@ -1147,42 +1153,18 @@ class File:
         return None
 
     def is_valid(self) -> bool:
-        types: tuple = ("archive", "archive_and_del", "sync")
-        setting_names: tuple = ("name", "on_start", "time", "setup")
-
-        if not isinstance(self.data, dict):
+        try:
+            _, errors = parse_config(self.data)
+        except TypeError:
             msgbox.showerror(self.msgbox_title, 'Invalid config: dict (JS object) expected!')
             return False
-        elif "config" not in self.data.keys():
+        except KeyError:
             msgbox.showerror(self.msgbox_title, 'Invalid config: no "config" key!')
             return False
 
-        for action in self.data["config"]:
-            if not isinstance(action, dict):
-                msgbox.showerror(self.msgbox_title, 'Invalid action: dict (JS object) expected!')
-                return False
-            elif len(action) != 1:
-                msgbox.showerror(self.msgbox_title, 'Invalid action: unexpected length!')
-                return False
-            elif action_type := tuple(action)[0] not in ACTION_TYPES:
-                msgbox.showerror(self.msgbox_title, f'Invalid action: unknown action ({action_type})!')
-                return False
-            for action_type in types:
-                if action_type not in action:
-                    continue
-                action_settings: dict = action[action_type]
-                if not isinstance(action_settings, dict):
-                    msgbox.showerror(self.msgbox_title, f'Invalid action "{action_type}" settings: '
-                                     'dict (JS object) expected')
-                    return False
-                elif len(action_settings) != 4:
-                    msgbox.showerror(self.msgbox_title, f'Invalid action "{action_type}" settings: '
-                                     'unexpected length')
-                    return False
-                elif set(action_settings) != set(setting_names):
-                    msgbox.showerror(self.msgbox_title, f'Invalid action "{action_type}" settings: '
-                                     f'wrong keys: {tuple(action_settings)}')
-                    return False
+        if errors:
+            msgbox.showerror(self.msgbox_title, f'{errors[0]}!')
+            return False
 
         return True
 
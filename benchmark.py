@@ -0,0 +1,440 @@
+"""Backup soft benchmarks
+
+Run: python benchmark.py [--json FILE] [name ...]
+     python benchmark.py --compare OLD_FILE NEW_FILE
+
+Benchmarks returning records (sync, archive, archive_and_del, scheduler)
+run every case in a fresh process and save them to the --json file, to
+be compared between commits.
+"""
+import os
+import sys
+import time
+import json
+import random
+import platform
+import tempfile
+import resource
+import threading
+import contextlib
+import subprocess
+import statistics
+import multiprocessing
+
+import main
+
+SIZES: tuple = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6)
+SHAPES: dict = {
+    # Layers of (subdir, depth, dirs per level, files per dir, file size)
+    "small": (('', 1, 100, 100, 2 ** 10),),
+    "huge": (('', 0, 0, 3, 32 * 2 ** 20),),
+    "deep": (('', 64, 1, 8, 16 * 2 ** 10),),
+    "mixed": (('docs', 2, 10, 40, 8 * 2 ** 10),
+              ('media', 0, 0, 2, 16 * 2 ** 20),
+              ('deep', 16, 1, 4, 256 * 2 ** 10))
+}
+ARCHIVE_FORMATS: tuple = ('zip', 'tar.gz')
+SYNC_ENGINES: tuple = ('threads', 'async')
+SCHEDULER_JOBS: tuple = (100, 2000)
+SCHEDULER_SECONDS: float = 5.0
+CHANGED_SHARE: float = 0.01
+
+
+def synthetic_walk(count: int, width: int = 100):
+    """Yields walk_trees-like listings of two trees with `count` entries"""
+    rngs: dict = {'A': random.Random(1), 'B': random.Random(2)}
+    yield '', dict((top, dict((f'dir{i}', main.FileEntry(True, 0, 0, i))
+                              for i in range(count // width)))
+                   for top in rngs)
+    for i in range(count // width):
+        listings: dict = {}
+        for top, rng in rngs.items():
+            listings[top] = dict(
+                (f'file{j}', main.FileEntry(False, 4096,
+                                            rng.choice((1, 2)) * 10 ** 9, j))
+                for j in range(width - 1) if rng.random() < 0.95
+            )
+        yield f'/dir{i}', listings
+
+
+def bench_plan() -> None:
+    print('plan_sync: entries, seconds, microseconds per entry')
+    for count in SIZES:
+        start: float = time.perf_counter()
+        for _ in main.plan_sync(synthetic_walk(count)):
+            pass
+        elapsed: float = time.perf_counter() - start
+        print(f'{count:>9} {elapsed:9.3f} {elapsed / count * 1e6:9.2f}')
+
+    return None
+
+
+def make_tree(root: str, text_files: int = 200, random_files: int = 8,
+              seed: int = 0) -> None:
+    """Writes a synthetic tree of compressible text and random data"""
+    rng: random.Random = random.Random(seed)
+    words: list = ['backup', 'archive', 'sync', 'delay', 'config', 'path']
+    for i in range(text_files):
+        directory: str = os.path.join(root, f'text{i % 10}')
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'{i}.txt'), 'w') as file:
+            file.write(' '.join(rng.choice(words) for _ in range(20000)))
+    os.makedirs(os.path.join(root, 'media'), exist_ok=True)
+    for i in range(random_files):
+        with open(os.path.join(root, 'media', f'{i}.bin'), 'wb') as file:
+            file.write(rng.randbytes(2 * 2 ** 20))
+
+    return None
+
+
+def tree_size(root: str) -> int:
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, _, filenames in os.walk(root)
+               for filename in filenames)
+
+
+def bench_formats() -> None:
+    print('archive: format, MiB/s, ratio')
+    with tempfile.TemporaryDirectory() as temp:
+        source: str = os.path.join(temp, 'source')
+        make_tree(source)
+        size: int = tree_size(source)
+        variants: list = [('zip', 'deflate'), ('zip', 'store'),
+                          ('tar.gz', None), ('tar.xz', None)]
+        if main.zstd is not None:
+            variants.append(('tar.zst', None))
+
+        for archive_format, method in variants:
+            target: str = os.path.join(temp, f'{archive_format}-{method}')
+            os.mkdir(target)
+            start: float = time.perf_counter()
+            main.archive(source, target, format=archive_format,
+                         method=method or 'deflate')
+            elapsed: float = time.perf_counter() - start
+            written: int = tree_size(target)
+            label: str = archive_format + (f' ({method})' if method else '')
+            print(f'{label:>15} {size / elapsed / 2 ** 20:9.1f} '
+                  f'{written / size:9.3f}')
+
+    return None
+
+
+def bench_delta(size: int = 256 * 2 ** 20, changes: int = 16) -> None:
+    print(f'delta: {size // 2 ** 20} MiB file, {changes} changed 4 KiB '
+          'spots; method, seconds, MiB written')
+    rng: random.Random = random.Random(0)
+    cwd: str = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp:
+        os.chdir(temp)
+        src: str = os.path.join(temp, 'src.img')
+        dst: str = os.path.join(temp, 'dst.img')
+        with open(src, 'wb') as file:
+            for _ in range(size // 2 ** 20):
+                file.write(rng.randbytes(2 ** 20))
+        main.copy_file(src, dst)
+
+        def modify() -> None:
+            with open(src, 'r+b') as file:
+                for _ in range(changes):
+                    file.seek(rng.randrange(size - 4096))
+                    file.write(rng.randbytes(4096))
+            os.utime(src, ns=(time.time_ns(), time.time_ns()))
+
+            return None
+
+        modify()
+        start: float = time.perf_counter()
+        main.copy_file(src, dst)
+        print(f'{"full copy":>22} {time.perf_counter() - start:9.3f} '
+              f'{size / 2 ** 20:9.1f}')
+
+        for label in ('delta, no signatures', 'delta, signatures'):
+            modify()
+            start = time.perf_counter()
+            written: int = main.delta_copy(src, dst)
+            print(f'{label:>22} {time.perf_counter() - start:9.3f} '
+                  f'{written / 2 ** 20:9.1f}')
+        os.chdir(cwd)
+
+    return None
+
+
+def make_shape(root: str, shape: str, seed: int = 0) -> None:
+    """Writes a synthetic tree of the shape, half compressible data"""
+    rng: random.Random = random.Random(seed)
+    for subdir, depth, width, files, size in SHAPES[shape]:
+        directories: list = [os.path.join(root, subdir)]
+        level: list = directories
+        for _ in range(depth):
+            level = [os.path.join(parent, f'dir{i}')
+                     for parent in level for i in range(width)]
+            directories += level
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+            for i in range(files):
+                with open(os.path.join(directory, f'file{i}.bin'),
+                          'wb') as file:
+                    for offset in range(0, size, main.COPY_BUFFER_SIZE):
+                        length: int = min(size - offset,
+                                          main.COPY_BUFFER_SIZE)
+                        file.write(rng.randbytes(length // 2)
+                                   + bytes(length - length // 2))
+
+    return None
+
+
+def tree_files(root: str) -> list:
+    return [os.path.join(dirpath, filename)
+            for dirpath, _, filenames in os.walk(root)
+            for filename in filenames]
+
+
+@contextlib.contextmanager
+def in_temp_dir():
+    """Runs the block in a temporary working directory, where the
+    sync index and done.json go"""
+    cwd: str = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp:
+        os.chdir(temp)
+        try:
+            yield temp
+        finally:
+            main.done_store.flush()
+            os.chdir(cwd)
+
+    return None
+
+
+def peak_rss(who: int = resource.RUSAGE_SELF) -> float:
+    """Returns the peak resident set size of this process (or of its
+    largest child), in MiB"""
+    peak: int = resource.getrusage(who).ru_maxrss
+
+    return round(peak / 2 ** (20 if sys.platform == 'darwin' else 10), 1)
+
+
+def run_case(func, args: tuple, sender) -> None:
+    record: dict = func(*args)
+    record["peak_rss_mib"] = peak_rss()
+    record["children_peak_rss_mib"] = peak_rss(resource.RUSAGE_CHILDREN)
+    sender.send(record)
+    sender.close()
+
+    return None
+
+
+def measure(func, *args) -> dict:
+    """Runs a case in a fresh process, so its peak RSS is its own"""
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_case, args=(func, args, sender))
+    process.start()
+    sender.close()
+    try:
+        record: dict = receiver.recv()
+    except EOFError:
+        raise ChildProcessError(f'{func.__name__}{args} failed') from None
+    finally:
+        process.join()
+    print('  '.join(f'{key}={value}' for key, value in record.items()))
+
+    return record
+
+
+def throughput(record: dict, files: int, size: int, seconds: float) -> dict:
+    record.update(files=files, mib=round(size / 2 ** 20, 1),
+                  seconds=round(seconds, 4),
+                  files_per_second=round(files / seconds, 1),
+                  mib_per_second=round(size / seconds / 2 ** 20, 1))
+
+    return record
+
+
+def sync_case(shape: str, engine: str) -> dict:
+    """Times a first sync, a sync with nothing changed and one after
+    CHANGED_SHARE of the files were saved again"""
+    with in_temp_dir() as temp:
+        source: str = os.path.join(temp, 'A')
+        target: str = os.path.join(temp, 'B')
+        make_shape(source, shape)
+        os.mkdir(target)
+        paths: list = tree_files(source)
+
+        start: float = time.perf_counter()
+        stats: main.RunStats = main.sync([source, target], engine=engine)
+        record: dict = throughput(
+            {"benchmark": "sync", "case": f'{shape}/{engine}'},
+            stats.files, stats.bytes, time.perf_counter() - start
+        )
+
+        start = time.perf_counter()
+        main.sync([source, target], engine=engine)
+        record["unchanged_seconds"] = round(time.perf_counter() - start, 4)
+
+        rng: random.Random = random.Random(1)
+        for path in rng.sample(paths, max(1, int(len(paths)
+                                                 * CHANGED_SHARE))):
+            # Written in place and dated later, as sync compares mtimes in
+            # whole seconds
+            with open(path, 'r+b') as file:
+                file.write(rng.randbytes(16))
+            os.utime(path, ns=(time.time_ns(), time.time_ns() + 2 * 10 ** 9))
+        start = time.perf_counter()
+        stats = main.sync([source, target], engine=engine)
+        record["changed_seconds"] = round(time.perf_counter() - start, 4)
+        record["changed_files"] = stats.files
+
+    return record
+
+
+def archive_case(shape: str, archive_format: str,
+                 delete: bool = False) -> dict:
+    with in_temp_dir() as temp:
+        source: str = os.path.join(temp, 'source')
+        target: str = os.path.join(temp, 'archives')
+        make_shape(source, shape)
+        os.mkdir(target)
+        size: int = tree_size(source)
+
+        func = main.archive_and_del if delete else main.archive
+        start: float = time.perf_counter()
+        stats: main.RunStats = func(source, target, format=archive_format)
+        record: dict = throughput(
+            {"benchmark": func.__name__,
+             "case": f'{shape}/{archive_format}'},
+            stats.files, size, time.perf_counter() - start
+        )
+        record["ratio"] = round(stats.written / size, 3)
+
+    return record
+
+
+class LatencyJob(main.Job):
+    """Job recording how late the scheduler started it, doing nothing"""
+
+    def __init__(self, name: str, seconds: float, latencies: list) -> None:
+        super().__init__(name, None, main.IntervalSchedule(seconds), {})
+        self.latencies: list = latencies
+
+        return None
+
+    def run(self, fire_time: float) -> None:
+        self.latencies.append(time.time() - fire_time)
+
+        return None
+
+
+def scheduler_case(jobs: int, seconds: float = SCHEDULER_SECONDS) -> dict:
+    """Runs the scheduler loop over jobs firing every 0.5 to 1 s and
+    records how late they start"""
+    with in_temp_dir():
+        latencies: list = []
+        scheduler: main.Scheduler = main.Scheduler(main.MAX_RUNNING_ACTIONS)
+        start: float = time.perf_counter()
+        for i in range(jobs):
+            scheduler.add(LatencyJob(f'job{i}', 0.5 + i % 50 / 100,
+                                     latencies))
+        added: float = time.perf_counter() - start
+        threading.Thread(target=scheduler.run, daemon=True).start()
+        time.sleep(seconds)
+        runs: list = sorted(latencies)
+
+    return {
+        "benchmark": "scheduler", "case": f'{jobs} jobs', "runs": len(runs),
+        "runs_per_second": round(len(runs) / seconds, 1),
+        "add_seconds": round(added, 4),
+        "latency_p50_ms": round(statistics.median(runs) * 1000, 2),
+        "latency_p99_ms": round(runs[int(len(runs) * 0.99)] * 1000, 2),
+        "latency_max_ms": round(runs[-1] * 1000, 2)
+    }
+
+
+def bench_sync() -> list:
+    return [measure(sync_case, shape, engine)
+            for shape in SHAPES for engine in SYNC_ENGINES]
+
+
+def bench_archive() -> list:
+    return [measure(archive_case, shape, archive_format)
+            for shape in SHAPES for archive_format in ARCHIVE_FORMATS]
+
+
+def bench_archive_and_del() -> list:
+    return [measure(archive_case, shape, 'zip', True) for shape in SHAPES]
+
+
+def bench_scheduler() -> list:
+    return [measure(scheduler_case, jobs) for jobs in SCHEDULER_JOBS]
+
+
+def save_results(path: str, records: list) -> None:
+    try:
+        commit: str = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit: str = None
+    results: dict = {
+        "commit": commit, "time": time.strftime('%Y-%m-%d %H:%M:%S'),
+        "python": platform.python_version(), "platform": platform.platform(),
+        "cpus": os.cpu_count(), "results": records
+    }
+    main.write_atomic(path, json.dumps(results, indent=2).encode())
+    print(f'Results saved to {path}')
+
+    return None
+
+
+def compare_results(old_path: str, new_path: str) -> None:
+    """Prints the change of every number of the records both files hold"""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    print(f'{old["commit"]} -> {new["commit"]}')
+    old_records: dict = dict(((record["benchmark"], record["case"]), record)
+                             for record in old["results"])
+    for record in new["results"]:
+        old_record: dict = old_records.get((record["benchmark"],
+                                            record["case"]))
+        if old_record is None:
+            continue
+        print(f'{record["benchmark"]} {record["case"]}')
+        for key, value in record.items():
+            before = old_record.get(key)
+            if (isinstance(value, (int, float))
+                    and isinstance(before, (int, float))):
+                change: str = (f'{(value - before) / before:+8.1%}'
+                               if before else '')
+                print(f'  {key:>20} {before:>12} {value:>12} {change}')
+
+    return None
+
+
+BENCHMARKS: dict = {
+    "plan": bench_plan,
+    "formats": bench_formats,
+    "delta": bench_delta,
+    "sync": bench_sync,
+    "archive": bench_archive,
+    "archive_and_del": bench_archive_and_del,
+    "scheduler": bench_scheduler
+}
+
+
+if __name__ == '__main__':
+    args: list = sys.argv[1:]
+    if args[:1] == ['--compare']:
+        compare_results(*args[1:3])
+        sys.exit()
+
+    json_path: str = None
+    if '--json' in args:
+        json_path = args.pop(args.index('--json') + 1)
+        args.remove('--json')
+
+    records: list = []
+    for name in args or BENCHMARKS:
+        records += BENCHMARKS[name]() or []
+    if json_path is not None:
+        save_results(json_path, records)
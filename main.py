@@ -4,14 +4,164 @@ Made by Leonid (https://t.me/G4m3_80ft)
 """
 import os
 import sys
+import math
+import heapq
 import shutil
 import time
+import datetime
+import itertools
 import logging
 import threading
 import json
+import zlib
+import errno
+import struct
+import functools
+import collections
+import multiprocessing
+import asyncio
+import gzip
+import lzma
+import tarfile
+import zipfile
+import atexit
+import hashlib
+import tempfile
+import contextlib
+import select
+import ctypes
+import ctypes.util
+import platform
+import inspect
+import dataclasses
+import http.server
+import io
+import cProfile
+import pstats
+import tracemalloc
+from stat import S_ISDIR, S_ISREG
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-ACTION_TYPES: tuple = ("archive", "archive_and_del", "sync")
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+ACTION_TYPES: tuple = ("archive", "archive_and_del", "sync", "dedup")
 ACTION_SETTING_NAMES: tuple = ("name", "on_start", "time", "setup")
+ACTION_OPTIONAL_SETTING_NAMES: tuple = ("executor", "nice", "ionice",
+                                        "misfire", "profile")
+MISFIRE_POLICIES: tuple = ("once", "all", "skip")
+MAX_MISSED_RUNS: int = 100
+ACTION_EXECUTORS: tuple = ("thread", "process")
+MAX_RUNNING_ACTIONS: int = 2
+CONFIG_POLL_SECONDS: float = 5.0
+THROUGHPUT_WEIGHT: float = 0.5
+DURATION_BUCKETS: tuple = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600)
+WAIT_BUCKETS: tuple = (0.01, 0.1, 1, 10, 60, 300)
+METRICS: dict = {
+    "backup_action_runs_total": ('counter', 'Action runs by result', None),
+    "backup_action_duration_seconds": ('histogram', 'Action run duration',
+                                       DURATION_BUCKETS),
+    "backup_action_stage_seconds": (
+        'histogram', 'Time spent in each stage of a run', DURATION_BUCKETS
+    ),
+    "backup_action_queue_wait_seconds": (
+        'histogram', 'Time a due action waited for a free slot', WAIT_BUCKETS
+    ),
+    "backup_action_files_scanned_total": ('counter', 'Files scanned', None),
+    "backup_action_files_total": ('counter', 'Files copied or archived',
+                                  None),
+    "backup_action_bytes_read_total": ('counter', 'Bytes read', None),
+    "backup_action_bytes_written_total": ('counter', 'Bytes written', None),
+    "backup_action_compression_ratio": (
+        'gauge', 'Bytes written per byte read in the last run', None
+    )
+}
+IOPRIO_CLASSES: dict = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_LEVELS: tuple = ('', '0', '1', '2', '3', '4', '5', '6', '7')
+IOPRIO_SET_SYSCALLS: dict = {
+    "x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314,
+    "riscv64": 30, "ppc64le": 273
+}
+TIME_UNITS: dict = {
+    "second": ("%S", "%T", "%X", "%c"),
+    "minute": ("%M", "%R"),
+    "hour": ("%H", "%I", "%p"),
+    "day": ("%d", "%j", "%a", "%A", "%w", "%u", "%U", "%W", "%x"),
+    "month": ("%m", "%B", "%b"),
+    "year": ("%Y", "%y")
+}
+MAX_SCHEDULE_STEPS: int = 100_000
+CRON_FIELDS: tuple = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+CRON_NAMES: dict = dict(
+    [(name, number) for number, name in enumerate(
+        ('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+         'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)]
+    + [(name, number) for number, name in enumerate(
+        ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'))]
+)
+CRON_ALIASES: dict = {
+    "@yearly": "0 0 1 1 *", "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *", "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *", "@midnight": "0 0 * * *", "@hourly": "0 * * * *"
+}
+DURATION_UNITS: dict = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+LOG_PATH: str = 'Dan7.log'
+PROFILE_DIR: str = os.path.join(os.path.dirname(LOG_PATH), 'profiles')
+PROFILE_TOP_FUNCTIONS: int = 30
+INDEX_DIR: str = 'sync_index'
+MAX_DELETED_SHARE: float = 0.5
+FICLONE: int = 0x40049409
+COPY_BUFFER_SIZE: int = 2 ** 20
+SCAN_QUEUE_SIZE: int = 16
+ARCHIVE_CHUNK_SIZE: int = 4 * 2 ** 20
+HASH_CHUNK_SIZE: int = ARCHIVE_CHUNK_SIZE
+DELTA_BLOCK_SIZE: int = 2 ** 20
+SIGNATURE_HEADER: struct.Struct = struct.Struct('<QqI')
+SIGNATURE_RECORD: struct.Struct = struct.Struct('<I8s')
+DEFLATE_WINDOW: int = 2 ** 15
+ZIP_METHODS: dict = {"store": 0, "deflate": 8}
+ARCHIVE_FORMATS: dict = {"zip": 6, "tar.gz": 6, "tar.xz": 6, "tar.zst": 3}
+MANIFEST_SUFFIX: str = '.manifest.gz'
+CDC_MIN_SIZE: int = 16 * 2 ** 10
+CDC_AVG_SIZE: int = 64 * 2 ** 10
+CDC_MAX_SIZE: int = 256 * 2 ** 10
+CDC_READ_SIZE: int = 4 * 2 ** 20
+CDC_MASK_STRICT: int = ((1 << 18) - 1) << 46
+CDC_MASK_LOOSE: int = ((1 << 14) - 1) << 50
+GEAR: tuple = tuple(
+    int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=8).digest(), 'big')
+    for i in range(256)
+)
+PACK_SIZE: int = 64 * 2 ** 20
+IN_ATTRIB: int = 0x4
+IN_CLOSE_WRITE: int = 0x8
+IN_MOVED_FROM: int = 0x40
+IN_MOVED_TO: int = 0x80
+IN_CREATE: int = 0x100
+IN_DELETE: int = 0x200
+IN_DELETE_SELF: int = 0x400
+IN_Q_OVERFLOW: int = 0x4000
+IN_IGNORED: int = 0x8000
+IN_ONLYDIR: int = 0x1000000
+IN_ISDIR: int = 0x40000000
+IN_CLOEXEC: int = 0o2000000
+WATCH_MASK: int = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                   | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+INOTIFY_EVENT: struct.Struct = struct.Struct('iIII')
+CHUNK_RECORD: struct.Struct = struct.Struct('<16sIQI')
+
+logger: logging.Logger = logging.getLogger(__name__)
 
 
 def main() -> None:
@@ -44,321 +194,4009 @@ def read_config() -> None:
         logger.warning('Sample config created, setup required')
         return None
 
-    with open('config.json', 'r') as config:
+    config: Config = load_config('config.json')
+    if config.metrics_port is not None:
+        serve_metrics(config.metrics_port)
+    scheduler: Scheduler = Scheduler(config.max_running_actions)
+    for action in config.actions:
+        job: Job = action.job()
+        if action.on_start:
+            scheduler.start(job)
+        scheduler.add(job, catch_up=not action.on_start)
+    threading.Thread(target=watch_config,
+                     args=('config.json', scheduler, config),
+                     name='config watch', daemon=True).start()
+
+    scheduler.run()
+
+    return None
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class ActionConfig:
+    """One validated action of the config, ready to be scheduled"""
+    type: str
+    name: str
+    on_start: bool
+    time: dict
+    setup: dict
+    executor: str = 'thread'
+    nice: int = None
+    ionice: str = None
+    misfire: str = 'once'
+    profile: bool = False
+    func: object = dataclasses.field(default=None, compare=False, repr=False)
+    schedule: object = dataclasses.field(default=None, compare=False,
+                                         repr=False)
+
+    def job(self) -> 'Job':
+        return Job(self.name, self.func, self.schedule, self.setup,
+                   self.executor, self.nice, self.ionice, self.misfire,
+                   self.profile)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Config:
+    actions: tuple
+    max_running_actions: int = MAX_RUNNING_ACTIONS
+    metrics_port: int = None
+
+
+def load_config(path: str) -> Config:
+    with open(path, 'r') as config:
         config = json.load(config)
     logger.debug('Config loaded')
 
-    if not isinstance(config, dict):
+    try:
+        config, errors = parse_config(config)
+    except TypeError:
         logger.critical('Invalid config: dict (JS object) expected')
-        raise TypeError('dict (JS object) expected')
-    elif "config" not in config.keys():
+        raise
+    except KeyError:
         logger.critical('Invalid config: no "config" key')
-        raise KeyError("config")
+        raise
+    for error in errors:
+        logger.warning(f'{error}, skipped')
     logger.debug('Config is correct')
 
-    config = config["config"]
+    return config
 
-    for action in config:
-        handle_action(action)
 
-    return None
+def parse_config(data: dict) -> tuple:
+    """Compiles config.json data into a Config
 
+    Returns the config and the errors of the actions left out of it.
+    Raises TypeError or KeyError if the data is not a config at all.
 
-def handle_action(action: dict) -> None:
-    global ACTION_TYPES, ACTION_SETTING_NAMES
+    >>> config, errors = parse_config({"config": [
+    ...     {"sync": {"name": "s", "on_start": False, "time": {"cron": "@daily"},
+    ...               "setup": {"paths_to_sync": ["A", "B"]}}},
+    ...     {"sync": {"name": "t", "on_start": False, "time": {"cron": "@daily"},
+    ...               "setup": {"paths": ["A", "B"]}}}]})
+    >>> [action.name for action in config.actions]
+    ['s']
+    >>> print(*errors)
+    Invalid action "t" setup: missing a required argument: 'paths_to_sync'
+    """
+    if not isinstance(data, dict):
+        raise TypeError('dict (JS object) expected')
+    elif "config" not in data.keys():
+        raise KeyError("config")
 
-    if not isinstance(action, dict):
-        logger.error('Invalid action: dict (JS object) expected')
-        return
-    elif len(action) != 1:
-        logger.error('Invalid action: unexpected length')
-        return
-    elif action_type := tuple(action)[0] not in ACTION_TYPES:
-        logger.error(f'Invalid action: unknown action ({action_type})')
-        return
-    for action_type in ACTION_TYPES:
-        if action_type not in action:
+    actions: dict = {}
+    errors: list = []
+    for action in data["config"]:
+        try:
+            action = parse_action(action)
+        except ValueError as error:
+            errors.append(str(error))
             continue
-        action_settings: dict = action[action_type]
-        if not isinstance(action_settings, dict):
-            logger.warning(f'Invalid action "{action_type}" settings: '
-                           'dict (JS object) expected')
+        if action.name in actions:
+            errors.append(f'Invalid action "{action.name}": duplicate name')
             continue
-        elif len(action_settings) != 4:
-            logger.warning(f'Invalid action "{action_type}" settings: '
-                           'unexpected length')
-            continue
-        elif set(action_settings) != set(ACTION_SETTING_NAMES):
-            logger.warning(f'Invalid action "{action_type}" settings: '
-                           f'wrong keys: {tuple(action_settings)}')
-            continue
-        logger.debug(f'Action "{action_settings["name"]}" ({action_type})'
-                     'settings are correct')
-        action_func = globals()[action_type]
-        if action_settings.pop("on_start"):
-            action_func(**action_settings["setup"])
-            time.sleep(1)
-        threading.Thread(
-            wait_for_activation(action_settings['name'],
-                                action_func,
-                                action_settings['time'],
-                                action_settings['setup']
-                                )
-        ).start()
+        actions[action.name] = action
 
-        return None
+    max_running: int = data.get("max_running_actions", MAX_RUNNING_ACTIONS)
+    if not isinstance(max_running, int) or max_running < 1:
+        errors.append(f'Invalid max_running_actions ({max_running!r})')
+        max_running = MAX_RUNNING_ACTIONS
 
+    metrics_port: int = data.get("metrics_port")
+    if metrics_port is not None and (not isinstance(metrics_port, int)
+                                     or not 0 < metrics_port < 65536):
+        errors.append(f'Invalid metrics_port ({metrics_port!r})')
+        metrics_port = None
+
+    return Config(tuple(actions.values()), max_running,
+                  metrics_port), errors
+
+
+def parse_action(action: dict) -> ActionConfig:
+    """Validates one action of the config, raising ValueError if invalid"""
+    if not isinstance(action, dict):
+        raise ValueError('Invalid action: dict (JS object) expected')
+    elif len(action) != 1:
+        raise ValueError('Invalid action: unexpected length')
+    action_type: str = tuple(action)[0]
+    if action_type not in ACTION_TYPES:
+        raise ValueError(f'Invalid action: unknown action ({action_type})')
+
+    settings: dict = action[action_type]
+    if not isinstance(settings, dict):
+        raise ValueError(f'Invalid action "{action_type}" settings: '
+                         'dict (JS object) expected')
+    elif (not set(ACTION_SETTING_NAMES) <= set(settings)
+          or not set(settings) <= set(ACTION_SETTING_NAMES
+                                      + ACTION_OPTIONAL_SETTING_NAMES)):
+        raise ValueError(f'Invalid action "{action_type}" settings: '
+                         f'wrong keys: {tuple(settings)}')
+
+    name = settings["name"]
+    if not isinstance(name, str):
+        raise ValueError(f'Invalid action "{action_type}" settings: '
+                         'name must be a string')
+    elif settings.get("executor", "thread") not in ACTION_EXECUTORS:
+        raise ValueError(f'Invalid action "{name}": unknown executor '
+                         f'({settings["executor"]})')
+    elif settings.get("misfire", "once") not in MISFIRE_POLICIES:
+        raise ValueError(f'Invalid action "{name}": unknown misfire '
+                         f'policy ({settings["misfire"]})')
+    elif not isinstance(settings.get("profile", False), bool):
+        raise ValueError(f'Invalid action "{name}": profile must be '
+                         'true or false')
+    elif not isinstance(settings.get("nice", 0), int):
+        raise ValueError(f'Invalid action "{name}": nice must be an integer')
+    elif settings.get("ionice") is not None and (
+            not isinstance(settings["ionice"], str)
+            or settings["ionice"].partition(':')[0] not in IOPRIO_CLASSES
+            or settings["ionice"].partition(':')[2] not in IOPRIO_LEVELS):
+        raise ValueError(f'Invalid action "{name}": unknown ionice class '
+                         f'or level ({settings["ionice"]})')
+    elif (not isinstance(settings["time"], dict)
+          or len(settings["time"]) != 1):
+        raise ValueError(f'Invalid action "{name}" time: one format '
+                         'expected')
+
+    schedule = compile_schedule(settings["time"])
+    func = globals()[action_type]
+    if not isinstance(settings["setup"], dict):
+        raise ValueError(f'Invalid action "{name}" setup: '
+                         'dict (JS object) expected')
+    try:
+        inspect.signature(func).bind(**settings["setup"])
+    except TypeError as error:
+        raise ValueError(f'Invalid action "{name}" setup: {error}') from None
+
+    return ActionConfig(action_type, name, bool(settings["on_start"]),
+                        settings["time"], settings["setup"],
+                        settings.get("executor", "thread"),
+                        settings.get("nice"), settings.get("ionice"),
+                        settings.get("misfire", "once"),
+                        settings.get("profile", False), func, schedule)
+
+
+def watch_config(path: str, scheduler: 'Scheduler', config: Config) -> None:
+    """Reloads the config when the file changes and reschedules the diff
+
+    Woken by inotify on the config directory where available, otherwise
+    by polling the file mtime. Only added, removed and changed actions are
+    rescheduled; runs in progress are left to finish. An invalid new
+    config is logged and the running one kept.
+    """
+    try:
+        inotify: Inotify = Inotify()
+        inotify.add_watch(os.path.dirname(os.path.abspath(path)),
+                          IN_CLOSE_WRITE | IN_MOVED_TO)
+    except (OSError, AttributeError, TypeError):
+        inotify = None
+    mtime_ns: int = os.stat(path).st_mtime_ns
 
-def wait_for_activation(action_name: str, action_func, action_time: dict,
-                        action_settings: dict) -> None:
-    time_format: str = tuple(action_time)[0]
-    time_setting: str = action_time[time_format]
-
-    minute: int = 60
-    hour: int = 60 * minute
-    day: int = 24 * hour
-    week: int = 7 * day
-    month: int = 31 * day
-    year: int = 366 * day
-    delay_between_checks: int = 1
-    delay_after_doing: int = 1
-    if '%M' in time_format:
-        delay_between_checks = minute // 4
-        delay_after_doing = minute
-    elif any((i in time_format for i in ('%H', '%I'))):
-        delay_between_checks = hour // 4
-        delay_after_doing = hour
-    elif any((i in time_format for i in ('%d', '%j'))):
-        delay_between_checks = 3 * hour
-        delay_after_doing = day
-    elif any((i in time_format for i in ('%U', '%W'))):
-        delay_between_checks = day
-        delay_after_doing = week
-    elif any((i in time_format for i in ('%m', '%B', '%b'))):
-        delay_between_checks = week
-        delay_after_doing = month
-    elif any((i in time_format for i in ('%Y', '%y'))):
-        delay_between_checks = month
-        delay_after_doing = year
-
-    logger.debug(f'Action "{action_name}" started waiting for activation '
-                 f'(delay between checks: {delay_between_checks}, '
-                 f'delay after doing: {delay_after_doing})')
     while True:
-        if is_time_right(time_format, time_setting) and has_no_delay(action_name):
-            action_func(**action_settings)
-            set_delay(action_name, delay_after_doing)
-        time.sleep(delay_between_checks)
+        if inotify is not None:
+            inotify.read(CONFIG_POLL_SECONDS)
+        else:
+            time.sleep(CONFIG_POLL_SECONDS)
+        try:
+            if os.stat(path).st_mtime_ns == mtime_ns:
+                continue
+            mtime_ns = os.stat(path).st_mtime_ns
+            new_config: Config = load_config(path)
+        except (OSError, ValueError, TypeError, KeyError) as error:
+            logger.error(f'Config reload failed, keeping the running one: '
+                         f'{error}')
+            continue
+        apply_config(scheduler, config, new_config)
+        config = new_config
 
 
-def is_time_right(time_format: str, time_setting: str) -> bool:
-    """Checks time
+def apply_config(scheduler: 'Scheduler', old: Config, new: Config) -> None:
+    old_actions: dict = dict((action.name, action) for action in old.actions)
+    new_actions: dict = dict((action.name, action) for action in new.actions)
+    removed: list = [name for name in old_actions
+                     if old_actions[name] != new_actions.get(name)]
+    added: list = [name for name in new_actions
+                   if new_actions[name] != old_actions.get(name)]
 
-    >>> import time
-    >>> is_time_right("%H", time.strftime("%H"))
-    True
-    >>> is_time_right("%S", time.strftime("%M"))
-    False
+    for name in removed:
+        scheduler.remove(name)
+    for name in added:
+        scheduler.add(new_actions[name].job())
+    if new.max_running_actions != old.max_running_actions:
+        scheduler.resize(new.max_running_actions)
+    if new.metrics_port != old.metrics_port:
+        logger.warning('metrics_port changed, restart to apply')
+    logger.info(f'Config reloaded ({len(added)} actions scheduled, '
+                f'{len(removed)} unscheduled)')
+
+    return None
+
+
+class Job:
+    """Scheduled action
+
+    Runs on the scheduler's thread or in a process of its own, at the
+    given CPU (nice) and I/O (ionice) priority. `misfire` tells what to do
+    with the runs missed while the program was down: run "once", run
+    "all" of them in order, or "skip" them. `profile` runs it under
+    cProfile and tracemalloc (see run_profiled). A sync with `watch` set
+    keeps running once started.
     """
-    return time.strftime(time_format) == time_setting
 
+    def __init__(self, name: str, func, schedule,
+                 settings: dict, executor: str = 'thread', nice: int = None,
+                 ionice: str = None, misfire: str = 'once',
+                 profile: bool = False) -> None:
+        self.name: str = name
+        self.func = func
+        self.schedule = schedule
+        self.settings: dict = settings
+        self.executor: str = executor
+        self.nice: int = nice
+        self.ionice: str = ionice
+        self.misfire: str = misfire
+        self.profile: bool = profile
+        self.watch: bool = bool(settings.get("watch", False))
 
-def has_no_delay(name_to_check: str) -> bool:
-    """Checks delay in done.json
+        return None
 
-    >>> import json
-    >>> has_no_delay("existing_name")
-    False
-    >>> has_no_delay("non_existing_name")
-    True
+    def next_fire(self, after: float):
+        return self.schedule.next_fire(after)
+
+    def execute(self) -> 'RunStats':
+        profile: bool = self.profile or profile_runs
+        if self.executor == 'process':
+            context = multiprocessing.get_context('spawn')
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(
+                target=run_action, name=self.name,
+                args=(self.name, self.func, self.settings, self.nice,
+                      self.ionice, profile, sender)
+            )
+            process.start()
+            sender.close()
+            try:
+                stats: RunStats = receiver.recv()
+            except EOFError:
+                stats: RunStats = None
+            process.join()
+            if process.exitcode != 0:
+                logger.error(f'Action "{self.name}" failed '
+                             f'(exit code {process.exitcode})')
+                raise ChildProcessError(f'Action {self.name!r} failed')
+            return stats
+
+        set_priority(self.nice, self.ionice)
+        return run_profiled(self.name, self.func, self.settings, profile)
+
+    def run(self, fire_time: float) -> None:
+        """Runs the job for a fire time, then records the next one as due
+
+        The next fire time is recorded only once the run is over, so a run
+        cut short by a crash is caught up after a restart.
+        """
+        try:
+            if not has_no_delay(self.name):
+                logger.debug(f'Action "{self.name}" skipped: delay is not '
+                             'over')
+                return None
+            self.run_now()
+            set_delay(self.name, max(0, round(
+                self.schedule.window_end(fire_time) - time.time()
+            )))
+            done_store.update_run(self.name, last_run=fire_time)
+        finally:
+            done_store.update_run(self.name, next_due=self.next_fire(
+                self.schedule.window_end(fire_time)
+            ))
+
+        return None
+
+    def run_now(self) -> None:
+        """Executes the action, recording its metrics and throughput"""
+        started: float = time.perf_counter()
+        result: str = 'error'
+        try:
+            stats: RunStats = self.execute()
+            result = 'ok'
+        finally:
+            metrics.observe('backup_action_duration_seconds',
+                            time.perf_counter() - started, action=self.name)
+            metrics.inc('backup_action_runs_total', action=self.name,
+                        result=result)
+        if stats is not None:
+            record_metrics(self.name, stats)
+            record_stages(self.name, stats.stages)
+            if stats.bytes and stats.seconds:
+                record_throughput(self.name, stats.bytes / stats.seconds)
+
+        return None
+
+    def missed_runs(self, now: float) -> list:
+        """Returns the fire times passed since the recorded next due one"""
+        record: dict = done_store.get_run(self.name)
+        if record is None or record.get("next_due") is None:
+            return []
+
+        missed: list = []
+        fire_time: float = record["next_due"]
+        while (fire_time is not None and fire_time < now
+               and len(missed) < MAX_MISSED_RUNS):
+            missed.append(fire_time)
+            fire_time = self.next_fire(self.schedule.window_end(fire_time))
+
+        return missed
+
+
+class Scheduler:
+    """Single heap of next fire times for all actions
+
+    The scheduler thread sleeps exactly until the earliest due job, so idle
+    cost does not depend on the number of actions. Due jobs start on
+    threads of their own, at most `max_running` at once; the rest wait for
+    a free slot. A run is skipped while the previous one of the same action
+    is still running or waiting for a slot. The scheduler thread and the
+    runs waiting for a slot wait on the same condition, notified to all.
     """
 
-    done: dict = load_done()
+    def __init__(self, max_running: int = MAX_RUNNING_ACTIONS) -> None:
+        self.queue: list = []
+        self.condition: threading.Condition = threading.Condition()
+        self.counter = itertools.count()
+        self.max_running: int = max_running
+        self.active: int = 0
+        self.jobs: dict = {}
+        self.running: set = set()
+
+        return None
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+    def add(self, job: Job, after: float = None,
+            catch_up: bool = True) -> None:
+        """Schedules the next run of the job
+
+        Added the first time (no `after`), the job first catches up with
+        the runs it missed according to its misfire policy, unless
+        `catch_up` is false because it was just started anyway. The next
+        due fire time is then recorded, unless the catch-up run records it
+        when over. Later, Job.run records it.
+        """
+        if after is None:
+            self.jobs[job.name] = job
+            after = time.time()
+            missed: list = job.missed_runs(after)
+            caught_up: bool = False
+            if missed:
+                if catch_up:
+                    caught_up = self.catch_up(job, missed)
+                else:
+                    logger.debug(f'Action "{job.name}" missed {len(missed)} '
+                                 'runs, caught up by its start run')
+                after = max(after, job.schedule.window_end(missed[-1]))
+            fire_time = job.next_fire(after)
+            if not caught_up:
+                done_store.update_run(job.name, next_due=fire_time)
+        else:
+            fire_time = job.next_fire(after)
+        if fire_time is None:
+            logger.warning(f'Action "{job.name}" will never be activated '
+                           f'({job.schedule})')
+            return None
+
+        with self.condition:
+            heapq.heappush(self.queue, (fire_time, next(self.counter), job))
+            self.condition.notify_all()
+        logger.debug(f'Action "{job.name}" scheduled at '
+                     f'{time.strftime("%d %b %Y %H:%M:%S", time.localtime(fire_time))}')
+
+        return None
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                fire_time, _, job = self.queue[0]
+                delay: float = fire_time - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.queue)
+
+            if not self.dispatch(job, job.run, fire_time):
+                done_store.update_run(job.name, next_due=job.next_fire(
+                    job.schedule.window_end(fire_time)
+                ))
+            if self.jobs.get(job.name) is job:
+                self.add(job, job.schedule.window_end(fire_time))
+
+    def remove(self, name: str) -> None:
+        """Unschedules the job of the action; a run in progress goes on"""
+        with self.condition:
+            self.jobs.pop(name, None)
+            self.queue = [item for item in self.queue if item[2].name != name]
+            heapq.heapify(self.queue)
+            self.condition.notify_all()
+        logger.debug(f'Action "{name}" unscheduled')
+
+        return None
+
+    def resize(self, max_running: int) -> None:
+        """Changes the cap; runs in progress count against the new one"""
+        with self.condition:
+            self.max_running = max_running
+            self.condition.notify_all()
+
+        return None
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Waits for fewer than `max_running` runs in progress, counting in"""
+        with self.condition:
+            while self.active >= self.max_running:
+                self.condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def catch_up(self, job: Job, missed: list) -> bool:
+        """Runs the missed fires the misfire policy keeps
+
+        Returns whether a catch-up run was started.
+        """
+        first: str = time.strftime('%d %b %Y %H:%M:%S',
+                                   time.localtime(missed[0]))
+        logger.info(f'Action "{job.name}" missed {len(missed)} runs since '
+                    f'{first} (misfire policy: {job.misfire})')
+        if job.misfire == 'skip':
+            return False
+        elif job.misfire == 'once':
+            missed = missed[-1:]
+
+        def run_missed() -> None:
+            for fire_time in missed:
+                job.run(fire_time)
+
+            return None
+
+        return self.dispatch(job, run_missed)
+
+    def start(self, job: Job) -> None:
+        """Runs the job now, regardless of its time and delay"""
+        self.dispatch(job, job.run_now)
+
+        return None
+
+    def dispatch(self, job: Job, func, *args) -> bool:
+        """Runs func(*args) for the job on a thread of its own
+
+        A watching job never returns, so it runs outside of the slots, on
+        a daemon thread; its later fires are skipped. Returns whether the
+        run was started.
+        """
+        name: str = job.name
+        with self.condition:
+            if name in self.running:
+                (logger.debug if job.watch else logger.info)(
+                    f'Action "{name}" skipped: previous run still in progress'
+                )
+                return False
+            self.running.add(name)
+        queued: float = time.perf_counter()
+
+        def run_in_slot() -> None:
+            try:
+                with contextlib.nullcontext() if job.watch else self.slot():
+                    metrics.observe('backup_action_queue_wait_seconds',
+                                    time.perf_counter() - queued,
+                                    action=name)
+                    func(*args)
+            except Exception:
+                logger.exception(f'Action "{name}" failed')
+            finally:
+                with self.condition:
+                    self.running.discard(name)
+
+            return None
+
+        # A new thread per run: a lowered thread priority cannot be raised
+        # back without privileges, so threads are not reused
+        threading.Thread(target=run_in_slot, name=name,
+                         daemon=job.watch).start()
 
-    for name, time_to_wait in done.items():
-        if name == name_to_check:
-            return time_to_wait <= time.time()
-    else:
         return True
 
 
-def set_delay(name: str, delay: int) -> None:
-    done: dict = load_done()
-    done[name] = delay
-    with open('done.json', 'r') as done_fp:
-        json.dump(done, done_fp, indent=2)
-    logger.debug(f'Set delay ({delay} secs) for "{name}"')
+def run_action(name: str, func, settings: dict, nice: int = None,
+               ionice: str = None, profile: bool = False,
+               sender=None) -> None:
+    """Runs an action in a process started by Job.execute
+
+    The run stats are sent back through `sender`.
+    """
+    if not logger.handlers:
+        setup_logger(logger)
+    set_priority(nice, ionice)
+    stats: RunStats = run_profiled(name, func, settings, profile)
+    if sender is not None:
+        sender.send(stats)
+        sender.close()
 
     return None
 
 
-def load_done() -> dict:
-    """Loads done.json
+def record_metrics(name: str, stats: 'RunStats') -> None:
+    metrics.inc('backup_action_files_scanned_total', stats.scanned,
+                action=name)
+    metrics.inc('backup_action_files_total', stats.files, action=name)
+    metrics.inc('backup_action_bytes_read_total', stats.bytes, action=name)
+    metrics.inc('backup_action_bytes_written_total', stats.written,
+                action=name)
+    if stats.bytes:
+        metrics.set('backup_action_compression_ratio',
+                    stats.written / stats.bytes, action=name)
 
-    >>> import json
-    >>> load_done()
-    {'existing_name': 100000000000000000000}
+    return None
+
+
+def record_stages(name: str, stages: dict) -> None:
+    if not stages:
+        return None
+    for stage_name, seconds in stages.items():
+        metrics.observe('backup_action_stage_seconds', seconds,
+                        action=name, stage=stage_name)
+    logger.debug(f'Action "{name}" stages: ' + ', '.join(
+        f'{stage_name} {seconds:.2f} s' for stage_name, seconds
+        in sorted(stages.items(), key=lambda item: -item[1])
+    ))
+
+    return None
+
+
+class StageTimer:
+    """Wall time and peak traced memory of the stages of an action run
+
+    Times are exclusive: a stage entered inside another one pauses it, so
+    they add up to the run time. Peaks are only recorded while tracemalloc
+    is tracing; they are process-wide, and while other profiled runs go on
+    they are not reset between stages, so a peak may include theirs.
+
+    >>> timer = StageTimer()
+    >>> timer.enter('run')
+    >>> timer.enter('scan')
+    >>> timer.leave()
+    >>> timer.leave()
+    >>> sorted(timer.seconds), timer.stack
+    (['run', 'scan'], [])
     """
 
-    with open('done.json', 'r') as done:
-        done = json.load(done)
+    def __init__(self) -> None:
+        self.seconds: dict = collections.defaultdict(float)
+        self.peaks: dict = collections.defaultdict(int)
+        self.stack: list = []
+        self.mark: float = time.perf_counter()
 
-    if not isinstance(done, dict):
-        logger.critical('Invalid JSON: dict (JS object) expected')
-        raise TypeError('dict (JS object) expected')
-    elif "done" not in done.keys():
-        logger.critical('Invalid JSON: no "done" key')
-        raise KeyError("done")
+        return None
 
-    logger.debug('"done.json" loaded correctly')
-    return done["done"]
+    def enter(self, name: str) -> None:
+        self.charge()
+        self.stack.append(name)
 
+        return None
 
-def setup_logger(lgr: logging.Logger) -> None:
-    lgr.setLevel(10)
-    formatter: logging.Formatter = logging.Formatter(
-        '[%(asctime)s] [%(levelname)s] '
-        '\"%(message)s\" in file %(pathname)s'
-    )
+    def leave(self) -> None:
+        self.charge()
+        self.stack.pop()
 
-    level: int = 0
-    if len(sys.argv) < 2:
-        level = 20
-    elif sys.argv[1].isdigit():
-        level = int(sys.argv[1])
+        return None
 
-    handlers: tuple = get_handlers()
-    set_formatter(formatter, handlers)
+    def charge(self) -> None:
+        """Charges the time and memory peak since the last mark to the
+        current stage"""
+        now: float = time.perf_counter()
+        if self.stack:
+            current: str = self.stack[-1]
+            self.seconds[current] += now - self.mark
+            if tracemalloc.is_tracing():
+                self.peaks[current] = max(self.peaks[current],
+                                          tracemalloc.get_traced_memory()[1])
+                if tracing["runs"] <= 1:
+                    tracemalloc.reset_peak()
+        self.mark = now
 
-    for handler in handlers:
-        handler.setLevel(level)
-        lgr.addHandler(handler)
+        return None
 
-    lgr.debug(f'Logger set (level: {level})')
+
+stage_timers: threading.local = threading.local()
+profile_runs: bool = False
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Times a stage of the action run of this thread, if it is timed"""
+    timer: StageTimer = getattr(stage_timers, 'timer', None)
+    if timer is None:
+        yield
+        return None
+
+    timer.enter(name)
+    try:
+        yield
+    finally:
+        timer.leave()
 
     return None
 
 
-def get_handlers() -> tuple:
-    stdout_handler: logging.Handler = logging.StreamHandler(sys.stdout)
-    logfile_handler: logging.Handler = logging.FileHandler('Dan7.log')
+def timed(name: str, iterable):
+    """Yields from `iterable`, timing the work done in it as a stage
 
-    return stdout_handler, logfile_handler
+    >>> list(timed('scan', range(3)))
+    [0, 1, 2]
+    """
+    iterator = iter(iterable)
+    end: object = object()
+    while True:
+        with stage(name):
+            item = next(iterator, end)
+        if item is end:
+            return None
+        yield item
 
 
-def set_formatter(formatter: logging.Formatter, handlers: tuple) -> None:
-    for handler in handlers:
-        handler.setFormatter(formatter)
+def run_profiled(name: str, func, settings: dict,
+                 profile: bool = False) -> 'RunStats':
+    """Runs an action with stage timers, under cProfile and tracemalloc
+    if `profile`
+
+    Time spent outside of any named stage is charged to "other". Work the
+    run hands to thread pools through profiled() is profiled with it;
+    worker processes are not.
+    """
+    timer: StageTimer = StageTimer()
+    stage_timers.timer = timer
+    profiler: cProfile.Profile = None
+    if profile:
+        start_tracing()
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            stage_timers.profilers = {}
+        except ValueError:
+            logger.warning(f'Action "{name}" not profiled: '
+                           'another profiler is active')
+            profiler = None
+    try:
+        with stage('other'):
+            stats: RunStats = func(**settings)
+    finally:
+        stage_timers.timer = None
+        if profiler is not None:
+            profiler.disable()
+            write_profile(name, [profiler]
+                          + list(stage_timers.profilers.values()), timer)
+            stage_timers.profilers = None
+        if profile:
+            stop_tracing()
+
+    if stats is None:
+        return None
+    return stats._replace(stages=dict(timer.seconds))
+
+
+def profiled(func):
+    """Returns func profiled with the action run of the calling thread,
+    whichever thread it is later called on
+
+    Each thread records into a profiler of its own, merged into the run's
+    profile at the end.
+    """
+    profilers: dict = getattr(stage_timers, 'profilers', None)
+    if profilers is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler: cProfile.Profile = profilers.get(threading.get_ident())
+        if profiler is None:
+            profiler = profilers[threading.get_ident()] = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Profilers built on sys.monitoring see every thread already
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+
+    return wrapper
+
+
+tracing: dict = {"runs": 0, "started": False}
+tracing_lock: threading.Lock = threading.Lock()
+
+
+def start_tracing() -> None:
+    """Starts tracemalloc for a profiled run, unless it is tracing already"""
+    with tracing_lock:
+        if tracing["runs"] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            tracing["started"] = True
+        tracing["runs"] += 1
 
     return None
 
 
-def sync(paths_to_sync: list) -> None:
-    check_paths(*paths_to_sync)
+def stop_tracing() -> None:
+    """Stops tracemalloc once the last profiled run is over, if started
+    by start_tracing"""
+    with tracing_lock:
+        tracing["runs"] -= 1
+        if tracing["runs"] == 0 and tracing["started"]:
+            tracemalloc.stop()
+            tracing["started"] = False
+
+    return None
+
 
-    paths: dict = get_paths(paths_to_sync)
-    paths: dict = filter_paths(paths)
-    create_dirs_and_files(paths)
-    logger.info(f'Paths {paths_to_sync} synced')
+def write_profile(name: str, profilers: list, timer: StageTimer) -> None:
+    """Writes the merged cProfile stats (.prof) of a run to PROFILE_DIR,
+    next to the log, with a summary of its stages and top functions (.txt)"""
+    os.makedirs(PROFILE_DIR or '.', exist_ok=True)
+    path: str = os.path.join(PROFILE_DIR, name.replace(os.sep, '_') + '_'
+                             + time.strftime('%Y-%m-%d_%H-%M-%S'))
+    summary: io.StringIO = io.StringIO()
+    stats: pstats.Stats = pstats.Stats(*profilers, stream=summary)
+    stats.dump_stats(path + '.prof')
+
+    summary.write(f'Action "{name}" run of {time.strftime("%c")}\n\n'
+                  f'{"stage":<12} {"seconds":>10} {"peak MiB":>10}\n')
+    for stage_name, seconds in sorted(timer.seconds.items(),
+                                      key=lambda item: -item[1]):
+        summary.write(f'{stage_name:<12} {seconds:10.3f} '
+                      f'{timer.peaks[stage_name] / 2 ** 20:10.1f}\n')
+    summary.write('\n')
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    write_atomic(path + '.txt', summary.getvalue().encode())
+    logger.info(f'Action "{name}" profiled: "{path}.txt"')
 
     return None
 
 
-def get_paths(tops: list) -> dict:
-    paths: dict = {}
+class Metrics:
+    """Process-wide metric values, rendered in Prometheus text format
 
-    for top in tops:
-        top: str = os.path.abspath(top)
-        paths[top]: list = [].copy()
+    Metrics are declared in METRICS; series are created on first use.
 
-        for dirpath, dirnames, filenames in os.walk(top):
-            dirpath = dirpath[len(top):]
+    >>> registry = Metrics()
+    >>> registry.inc('backup_action_runs_total', action='a', result='ok')
+    >>> registry.observe('backup_action_queue_wait_seconds', 0.5, action='a')
+    >>> lines = registry.render().splitlines()
+    >>> for line in lines[:3]:
+    ...     print(line)
+    # HELP backup_action_runs_total Action runs by result
+    # TYPE backup_action_runs_total counter
+    backup_action_runs_total{action="a",result="ok"} 1
+    >>> histogram = [line for line in lines
+    ...              if line.startswith('backup_action_queue')]
+    >>> for line in histogram[1:3] + histogram[-2:]:
+    ...     print(line)
+    backup_action_queue_wait_seconds_bucket{action="a",le="0.1"} 0
+    backup_action_queue_wait_seconds_bucket{action="a",le="1"} 1
+    backup_action_queue_wait_seconds_sum{action="a"} 0.5
+    backup_action_queue_wait_seconds_count{action="a"} 1
+    """
 
-            for path in dirnames + filenames:
-                paths[top].append(dirpath + os.sep + path)
-                if len(paths[top]) > 50:
-                    break
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.series: dict = dict((name, {}) for name in METRICS)
 
-        paths[top] = sorted(paths[top], key=len)
+        return None
 
-    logger.debug(f'Paths {tops} scanned')
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key: tuple = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[name][key] = self.series[name].get(key, 0) + value
 
-    return paths
+        return None
 
+    def set(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.series[name][tuple(sorted(labels.items()))] = value
 
-def filter_paths(paths: dict) -> dict:
-    for top, rel_paths in paths.items():
-        for other_top in paths:
-            if other_top == top:
-                continue
-            for rel_path in rel_paths:
-                if rel_path not in paths[other_top]:
-                    continue
+        return None
 
-                if (round(os.path.getmtime(top + rel_path))
-                        == round(os.path.getmtime(other_top + rel_path))):
-                    continue
-                elif (round(os.path.getmtime(top + rel_path))
-                      > round(os.path.getmtime(other_top + rel_path))):
-                    paths[top].remove(rel_path)
-                else:
-                    paths[other_top].remove(rel_path)
+    def observe(self, name: str, value: float, **labels) -> None:
+        key: tuple = tuple(sorted(labels.items()))
+        buckets: tuple = METRICS[name][2]
+        with self.lock:
+            histogram: list = self.series[name].setdefault(
+                key, [[0] * len(buckets), 0, 0]
+            )
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
 
-    logger.debug(f'Paths {tuple(paths)} filtered')
+        return None
 
-    return paths
+    def render(self) -> str:
+        lines: list = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in METRICS.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for key, value in sorted(self.series[name].items()):
+                    if kind != 'histogram':
+                        lines.append(f'{name}{format_labels(key)} '
+                                     f'{format_value(value)}')
+                        continue
+                    counts, total, count = value
+                    for bound, bucket_count in zip(buckets + ('+Inf',),
+                                                   counts + [count]):
+                        le: tuple = key + (('le', format_value(bound)),)
+                        lines.append(f'{name}_bucket{format_labels(le)} '
+                                     f'{bucket_count}')
+                    lines.append(f'{name}_sum{format_labels(key)} '
+                                 f'{format_value(total)}')
+                    lines.append(f'{name}_count{format_labels(key)} {count}')
 
+        return '\n'.join(lines) + '\n'
 
-def create_dirs_and_files(paths: dict) -> None:
-    for top, rel_paths in paths.items():
-        for other_top in paths:
-            if other_top == top:
-                continue
-            for rel_path in rel_paths:
-                if os.path.isdir(top + rel_path):
-                    os.mkdir(other_top + rel_path)
-                elif os.path.isfile(top + rel_path):
-                    shutil.copy2(top + rel_path, other_top + rel_path)
 
-    logger.debug(f'Paths {tuple(paths)} created')
+def format_labels(labels: tuple) -> str:
+    """Formats label pairs, escaping the values
 
-    return None
+    >>> format_labels((('action', 'a "b"'),))
+    '{action="a \\\\"b\\\\""}'
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        f'{key}="' + str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    ) + '}'
 
 
-def archive(from_path: str, to_path: str = os.getcwd()) -> None:
-    from_path = os.path.normpath(from_path)
-    to_path = os.path.normpath(to_path)
+def format_value(value) -> str:
+    return repr(value) if isinstance(value, float) else str(value)
 
-    check_paths(from_path, to_path)
-    shutil.make_archive(to_path + os.sep + time.strftime('%d.%m.%y_%H-%M-%S'),
-                        'zip', from_path)
 
-    logger.info(f'Archived from "{from_path}" to "{to_path}"')
+metrics: Metrics = Metrics()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the metrics at /metrics"""
+
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+            return None
+
+        body: bytes = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; '
+                                         'charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        return None
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f'Metrics request: {format % args}')
+
+        return None
+
+
+def serve_metrics(port: int, host: str = '127.0.0.1') -> None:
+    """Starts the metrics endpoint on a daemon thread"""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    logger.info(f'Metrics served at http://{host}:{port}/metrics')
 
     return None
 
 
-def archive_and_del(from_path: str, to_path: str = os.getcwd()) -> None:
-    archive(from_path, to_path)
-    shutil.rmtree(from_path, True)
+def record_throughput(name: str, bytes_per_second: float) -> None:
+    """Keeps a moving average of the action throughput for plan estimates"""
+    record: dict = done_store.get_run(name) or {}
+    old: float = record.get("bytes_per_second")
+    if old is not None:
+        bytes_per_second = THROUGHPUT_WEIGHT * bytes_per_second + (
+            1 - THROUGHPUT_WEIGHT
+        ) * old
+    done_store.update_run(name, bytes_per_second=round(bytes_per_second))
+
+    return None
 
-    logger.info(f'Removed tree "{from_path}"')
+
+def set_priority(nice: int = None, ionice: str = None) -> None:
+    """Sets the CPU and I/O priority of the calling thread
+
+    `ionice` is a class ("realtime", "best-effort" or "idle"), optionally
+    followed by a level from 0 (highest) to 7: "best-effort:6". Threads
+    started afterwards inherit both. Failures are logged, not raised.
+    """
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+        except (OSError, AttributeError) as error:
+            logger.warning(f'Cannot set nice {nice}: {error}')
+
+    if ionice is not None:
+        io_class, _, level = ionice.partition(':')
+        syscall: int = IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if io_class not in IOPRIO_CLASSES or syscall is None:
+            logger.warning(f'Cannot set ionice {ionice!r}: unknown class '
+                           'or unsupported platform')
+            return None
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # IOPRIO_WHO_PROCESS with a thread ID sets the thread priority
+        if libc.syscall(syscall, 1, threading.get_native_id(),
+                        IOPRIO_CLASSES[io_class] << 13
+                        | int(level or 4)) < 0:
+            logger.warning(f'Cannot set ionice {ionice!r}: '
+                           f'{os.strerror(ctypes.get_errno())}')
 
     return None
 
 
-def check_paths(*paths) -> None:
-    for path_ in paths:
-        if not os.path.exists(path_):
-            logger.critical(f'No such directory: {repr(path_)}')
-            raise FileNotFoundError(f'No such directory: {repr(path_)}')
+def time_unit(time_format: str) -> str:
+    """Returns the finest time unit of the format
+
+    >>> time_unit("%d %b %Y %H:%M")
+    'minute'
+    >>> time_unit("%B")
+    'month'
+    """
+    for unit in ('second', 'minute', 'hour', 'day', 'month', 'year'):
+        if any(directive in time_format for directive in TIME_UNITS[unit]):
+            return unit
+    return 'second'
+
+
+def next_unit_start(moment: datetime.datetime,
+                    unit: str) -> datetime.datetime:
+    if unit == 'second':
+        return moment.replace(microsecond=0) + datetime.timedelta(seconds=1)
+    elif unit == 'minute':
+        return (moment.replace(second=0, microsecond=0)
+                + datetime.timedelta(minutes=1))
+    elif unit == 'hour':
+        return (moment.replace(minute=0, second=0, microsecond=0)
+                + datetime.timedelta(hours=1))
+    elif unit == 'day':
+        return (moment.replace(hour=0, minute=0, second=0, microsecond=0)
+                + datetime.timedelta(days=1))
+    elif unit == 'month':
+        if moment.month == 12:
+            return datetime.datetime(moment.year + 1, 1, 1)
+        return datetime.datetime(moment.year, moment.month + 1, 1)
+    return datetime.datetime(moment.year + 1, 1, 1)
+
+
+def window_end(time_format: str, fire_time: float) -> float:
+    """Returns the end of the time window the format matched in
+
+    >>> import time
+    >>> start = time.mktime((2000, 1, 1, 3, 30, 20, 0, 0, -1))
+    >>> window_end("%H:%M", start) - start
+    40.0
+    """
+    moment = datetime.datetime.fromtimestamp(fire_time)
+    return next_unit_start(moment, time_unit(time_format)).timestamp()
+
+
+def next_fire_time(time_format: str, time_setting: str, after: float):
+    """Returns the first moment not before `after` matching the setting
+
+    Fields fixed by the format are compared from the coarsest to the finest
+    and mismatches jump straight to the start of the next unit, so a match
+    is found in a few steps instead of polling. None means no match.
+
+    >>> import time
+    >>> start = time.mktime((2000, 1, 1, 0, 0, 0, 0, 0, -1))
+    >>> fire = next_fire_time("%H:%M", "03:30", start)
+    >>> time.strftime("%d %b %Y %H:%M:%S", time.localtime(fire))
+    '01 Jan 2000 03:30:00'
+    >>> fire = next_fire_time("%d %H", "15 12", start)
+    >>> time.strftime("%d %b %Y %H:%M:%S", time.localtime(fire))
+    '15 Jan 2000 12:00:00'
+    >>> next_fire_time("%Y", "1999", start) is None
+    True
+    """
+    try:
+        fixed: time.struct_time = time.strptime(time_setting, time_format)
+    except ValueError:
+        logger.error(f'Invalid time setting {time_setting!r} '
+                     f'for format {time_format!r}')
+        return None
+
+    def has(*directives) -> bool:
+        return any(directive in time_format for directive in directives)
+
+    unit: str = time_unit(time_format)
+    moment = datetime.datetime.fromtimestamp(math.ceil(after))
+    for _ in range(MAX_SCHEDULE_STEPS):
+        if has('%Y', '%y') and moment.year != fixed.tm_year:
+            if moment.year > fixed.tm_year:
+                return None
+            moment = datetime.datetime(fixed.tm_year, 1, 1)
+        elif has('%m', '%B', '%b') and moment.month != fixed.tm_mon:
+            moment = next_unit_start(moment, 'month')
+        elif ((has('%d') and moment.day != fixed.tm_mday)
+              or (has('%j') and moment.timetuple().tm_yday != fixed.tm_yday)
+              or (has('%a', '%A', '%w', '%u')
+                  and moment.weekday() != fixed.tm_wday)):
+            moment = next_unit_start(moment, 'day')
+        elif has('%H', '%I') and (
+                moment.hour != fixed.tm_hour if not has('%I') or has('%p')
+                else moment.hour % 12 != fixed.tm_hour % 12):
+            moment = next_unit_start(moment, 'hour')
+        elif has('%M') and moment.minute != fixed.tm_min:
+            moment = next_unit_start(moment, 'minute')
+        elif has('%S') and moment.second != fixed.tm_sec:
+            moment = next_unit_start(moment, 'second')
+        elif moment.strftime(time_format) != time_setting:
+            moment = next_unit_start(moment, unit)
+        else:
+            return moment.timestamp()
 
     return None
 
 
+def is_time_right(time_format: str, time_setting: str) -> bool:
+    """Checks time
+
+    >>> import time
+    >>> is_time_right("%H", time.strftime("%H"))
+    True
+    >>> is_time_right("%S", time.strftime("%M"))
+    False
+    """
+    return time.strftime(time_format) == time_setting
+
+
+def compile_schedule(action_time: dict):
+    """Parses the "time" block of an action once into a schedule
+
+    {"cron": ...} takes a five-field cron expression, an @alias or an
+    interval like "every 15m"; any other key is a strftime format matched
+    against its value. Raises ValueError on an invalid expression.
+
+    >>> compile_schedule({"cron": "every 1h30m"})
+    IntervalSchedule(5400)
+    >>> compile_schedule({"cron": "@daily"})
+    CronSchedule('0 0 * * *')
+    >>> compile_schedule({"%H:%M": "25:00"})
+    Traceback (most recent call last):
+    ValueError: Invalid time setting '25:00' for format '%H:%M'
+    """
+    time_format: str = tuple(action_time)[0]
+    expression: str = action_time[time_format]
+    if time_format != 'cron':
+        return StrftimeSchedule(time_format, expression)
+
+    expression = CRON_ALIASES.get(expression.strip(), expression.strip())
+    if expression.startswith('every '):
+        return IntervalSchedule(parse_duration(expression[6:]))
+    return CronSchedule(expression)
+
+
+def parse_duration(text: str) -> int:
+    """Returns the seconds of a duration like "90s", "15m" or "1d12h"
+
+    >>> parse_duration("1d12h")
+    129600
+    """
+    seconds: int = 0
+    number: str = ''
+    for char in text.replace(' ', ''):
+        if char.isdigit():
+            number += char
+        elif char in DURATION_UNITS and number:
+            seconds += int(number) * DURATION_UNITS[char]
+            number = ''
+        else:
+            raise ValueError(f'Invalid duration: {text!r}')
+    if number or not seconds:
+        raise ValueError(f'Invalid duration: {text!r}')
+
+    return seconds
+
+
+class StrftimeSchedule:
+    """Fires in every window where the strftime format gives the setting"""
+
+    def __init__(self, time_format: str, time_setting: str) -> None:
+        try:
+            time.strptime(time_setting, time_format)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid time setting {time_setting!r} '
+                             f'for format {time_format!r}') from None
+        self.time_format: str = time_format
+        self.time_setting: str = time_setting
+
+        return None
+
+    def __repr__(self) -> str:
+        return f'{self.time_format!r}: {self.time_setting!r}'
+
+    def next_fire(self, after: float):
+        return next_fire_time(self.time_format, self.time_setting, after)
+
+    def window_end(self, fire_time: float) -> float:
+        return window_end(self.time_format, fire_time)
+
+
+class IntervalSchedule:
+    """Fires every `seconds`, at multiples counted from local midnight
+    of 1 Jan 2000, so restarts keep the same fire times
+
+    >>> import time
+    >>> start = time.mktime((2000, 1, 1, 3, 7, 0, 0, 0, -1))
+    >>> schedule = IntervalSchedule(15 * 60)
+    >>> time.strftime("%H:%M:%S", time.localtime(schedule.next_fire(start)))
+    '03:15:00'
+    """
+
+    def __init__(self, seconds: int) -> None:
+        self.seconds: int = seconds
+        self.origin: float = time.mktime((2000, 1, 1, 0, 0, 0, 0, 0, -1))
+
+        return None
+
+    def __repr__(self) -> str:
+        return f'IntervalSchedule({self.seconds})'
+
+    def next_fire(self, after: float) -> float:
+        return self.origin + math.ceil(
+            (after - self.origin) / self.seconds
+        ) * self.seconds
+
+    def window_end(self, fire_time: float) -> float:
+        return fire_time + self.seconds
+
+
+class CronSchedule:
+    """Five-field cron expression: minute hour day-of-month month weekday
+
+    Fields take *, numbers, names (jan, mon), ranges, lists and /steps.
+    Like cron, a day matches either day field when both are restricted.
+
+    >>> import time
+    >>> start = time.mktime((2000, 1, 1, 0, 0, 0, 0, 0, -1))
+    >>> schedule = CronSchedule("*/15 9-17 * * mon-fri")
+    >>> time.strftime("%a %d %H:%M", time.localtime(schedule.next_fire(start)))
+    'Mon 03 09:00'
+    >>> fire = CronSchedule("30 4 1,15 * 5").next_fire(start)
+    >>> time.strftime("%a %d %H:%M", time.localtime(fire))
+    'Sat 01 04:30'
+    >>> CronSchedule("0 0 30 2 *").next_fire(start) is None
+    True
+    """
+
+    def __init__(self, expression: str) -> None:
+        self.expression: str = expression
+        fields: list = expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f'Invalid cron expression: {expression!r}')
+
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_cron_field(field, low, high)
+            for field, (low, high) in zip(fields, CRON_FIELDS)
+        )
+        self.weekdays: set = set(weekday % 7 for weekday in weekdays)
+        self.any_day: bool = fields[2] == '*'
+        self.any_weekday: bool = fields[4] == '*'
+
+        return None
+
+    def __repr__(self) -> str:
+        return f'CronSchedule({self.expression!r})'
+
+    def day_matches(self, moment: datetime.datetime) -> bool:
+        day: bool = moment.day in self.days
+        weekday: bool = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_fire(self, after: float):
+        moment = datetime.datetime.fromtimestamp(math.ceil(after))
+        if moment.second:
+            moment = next_unit_start(moment, 'minute')
+        for _ in range(MAX_SCHEDULE_STEPS):
+            if moment.month not in self.months:
+                moment = next_unit_start(moment, 'month')
+            elif not self.day_matches(moment):
+                moment = next_unit_start(moment, 'day')
+            elif moment.hour not in self.hours:
+                moment = next_unit_start(moment, 'hour')
+            elif moment.minute not in self.minutes:
+                moment = next_unit_start(moment, 'minute')
+            else:
+                return moment.timestamp()
+
+        return None
+
+    def window_end(self, fire_time: float) -> float:
+        return window_end('%M', fire_time)
+
+
+def parse_cron_field(field: str, low: int, high: int) -> set:
+    """Returns the values a cron field matches
+
+    >>> sorted(parse_cron_field("1-10/3,jan", 1, 12))
+    [1, 4, 7, 10]
+    """
+    values: set = set()
+    for part in field.lower().split(','):
+        part, _, step_text = part.partition('/')
+        start_text, _, stop_text = part.partition('-')
+        try:
+            step: int = int(step_text or 1)
+            if part == '*':
+                start, stop = low, high
+            else:
+                start = int(CRON_NAMES.get(start_text, start_text))
+                stop = (int(CRON_NAMES.get(stop_text, stop_text)) if stop_text
+                        else high if step_text else start)
+        except ValueError:
+            raise ValueError(f'Invalid cron field: {field!r}') from None
+        if not low <= start <= stop <= high or step < 1:
+            raise ValueError(f'Invalid cron field: {field!r}')
+        values.update(range(start, stop + 1, step))
+
+    return values
+
+
+def has_no_delay(name_to_check: str) -> bool:
+    """Checks delay in done.json
+
+    >>> import json
+    >>> has_no_delay("existing_name")
+    False
+    >>> has_no_delay("non_existing_name")
+    True
+    """
+
+    time_to_wait = done_store.get(name_to_check)
+
+    return time_to_wait is None or time_to_wait <= time.time()
+
+
+def set_delay(name: str, delay: int) -> None:
+    """Stores the moment the delay ends, so it survives restarts"""
+    done_store.set(name, round(time.time() + delay))
+    logger.debug(f'Set delay ({delay} secs) for "{name}"')
+
+    return None
+
+
+def load_done() -> dict:
+    """Loads done.json
+
+    >>> import json
+    >>> load_done()
+    {'existing_name': 100000000000000000000}
+    """
+
+    return done_store.load()
+
+
+class DoneStore:
+    """Process-wide copy of done.json
+
+    The file is read once, lookups are answered from memory and changes are
+    written back in batches by a timer thread (temp file + rename). Besides
+    the delays ("done"), it keeps the last run and next due fire time of
+    every action ("runs").
+    """
+
+    def __init__(self, path: str = 'done.json',
+                 flush_delay: float = 5.0) -> None:
+        self.path: str = path
+        self.flush_delay: float = flush_delay
+        self.lock: threading.RLock = threading.RLock()
+        self.write_lock: threading.Lock = threading.Lock()
+        self.data: dict = None
+        self.dirty: bool = False
+        self.flusher: threading.Timer = None
+
+        return None
+
+    def read(self) -> dict:
+        if not os.path.exists(self.path):
+            logger.warning(f'"{self.path}" not found, starting empty')
+            return {"done": {}}
+
+        with open(self.path, 'r') as done:
+            done = json.load(done)
+
+        if not isinstance(done, dict):
+            logger.critical('Invalid JSON: dict (JS object) expected')
+            raise TypeError('dict (JS object) expected')
+        elif "done" not in done.keys():
+            logger.critical('Invalid JSON: no "done" key')
+            raise KeyError("done")
+
+        logger.debug(f'"{self.path}" loaded correctly')
+        return done
+
+    def load(self) -> dict:
+        with self.lock:
+            if self.data is None:
+                self.data = self.read()
+            return dict(self.data["done"])
+
+    def get(self, name: str, default=None):
+        with self.lock:
+            if self.data is None:
+                self.data = self.read()
+            return self.data["done"].get(name, default)
+
+    def get_run(self, name: str) -> dict:
+        with self.lock:
+            if self.data is None:
+                self.data = self.read()
+            record: dict = self.data.get("runs", {}).get(name)
+            return dict(record) if record is not None else None
+
+    def update_run(self, name: str, **fields) -> None:
+        with self.lock:
+            if self.data is None:
+                self.data = self.read()
+            self.data.setdefault("runs", {}).setdefault(name, {}).update(
+                fields
+            )
+            self.changed()
+
+        return None
+
+    def set(self, name: str, value) -> None:
+        with self.lock:
+            if self.data is None:
+                self.data = self.read()
+            self.data["done"][name] = value
+            self.changed()
+
+        return None
+
+    def changed(self) -> None:
+        with self.lock:
+            self.dirty = True
+            if self.flusher is None:
+                self.flusher = threading.Timer(self.flush_delay, self.flush)
+                self.flusher.daemon = True
+                self.flusher.start()
+
+        return None
+
+    def flush(self) -> None:
+        with self.write_lock:
+            with self.lock:
+                self.flusher = None
+                if not self.dirty:
+                    return None
+                text: str = json.dumps(self.data, indent=2)
+                self.dirty = False
+
+            try:
+                write_atomic(self.path, text.encode())
+            except BaseException:
+                with self.lock:
+                    self.dirty = True
+                raise
+
+        logger.debug(f'"{self.path}" saved')
+
+        return None
+
+
+done_store: DoneStore = DoneStore()
+atexit.register(done_store.flush)
+
+
+def get_umask() -> int:
+    mask: int = os.umask(0o022)
+    os.umask(mask)
+
+    return mask
+
+
+# Read once at import: setting the umask is not thread-safe
+FILE_MODE: int = 0o666 & ~get_umask()
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Replaces the file with `data` at once, keeping its mode
+
+    A new file gets the mode open() would give it.
+    """
+    dirname: str = os.path.dirname(os.path.abspath(path))
+    try:
+        mode: int = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode: int = FILE_MODE
+    fd, temp_path = tempfile.mkstemp(prefix='.tmp-', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as temp_fp:
+            temp_fp.write(data)
+            temp_fp.flush()
+            os.fsync(temp_fp.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return None
+
+
+def setup_logger(lgr: logging.Logger) -> None:
+    lgr.setLevel(10)
+    formatter: logging.Formatter = logging.Formatter(
+        '[%(asctime)s] [%(levelname)s] '
+        '\"%(message)s\" in file %(pathname)s'
+    )
+
+    level: int = 20
+    if len(sys.argv) > 1 and sys.argv[1].isdigit():
+        level = int(sys.argv[1])
+
+    handlers: tuple = get_handlers()
+    set_formatter(formatter, handlers)
+
+    for handler in handlers:
+        handler.setLevel(level)
+        lgr.addHandler(handler)
+
+    lgr.debug(f'Logger set (level: {level})')
+
+    return None
+
+
+def get_handlers() -> tuple:
+    stdout_handler: logging.Handler = logging.StreamHandler(sys.stdout)
+    logfile_handler: logging.Handler = logging.FileHandler(LOG_PATH)
+
+    return stdout_handler, logfile_handler
+
+
+def set_formatter(formatter: logging.Formatter, handlers: tuple) -> None:
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    return None
+
+
+class RunStats(NamedTuple):
+    """What an action run did, returned by every action function
+
+    `files` and `bytes` are the files processed and bytes read; `scanned`
+    counts the files looked at, `written` the bytes stored. `stages` maps
+    the stages of the run to their seconds (see StageTimer).
+    """
+    files: int
+    bytes: int
+    seconds: float
+    scanned: int = 0
+    written: int = 0
+    stages: dict = None
+
+
+def sync(paths_to_sync: list, full_rescan_hours: float = 24,
+         copy_threads: int = 4, verify: bool = False,
+         delta_threshold: int = 64 * 2 ** 20, engine: str = 'threads',
+         max_in_flight: int = 64, deletions: bool = False,
+         trash: str = None, watch: bool = False, debounce: float = 2.0,
+         reconcile_minutes: float = 60,
+         max_deleted_share: float = MAX_DELETED_SHARE) -> RunStats:
+    check_paths(*paths_to_sync)
+
+    index: SyncIndex = SyncIndex(paths_to_sync)
+    run = functools.partial(
+        sync_run, index, copy_threads=copy_threads, verify=verify,
+        delta_threshold=delta_threshold, engine=engine,
+        max_in_flight=max_in_flight, deletions=deletions, trash=trash,
+        max_deleted_share=max_deleted_share
+    )
+    if watch:
+        watch_sync(index, run, full_rescan_hours, debounce,
+                   reconcile_minutes)
+        return None
+
+    return run(index.scanned + full_rescan_hours * 3600 <= time.time())
+
+
+def sync_run(index: 'SyncIndex', full_scan: bool, dirty: set = None,
+             copy_threads: int = 4, verify: bool = False,
+             delta_threshold: int = None, engine: str = 'threads',
+             max_in_flight: int = 64, deletions: bool = False,
+             trash: str = None,
+             max_deleted_share: float = MAX_DELETED_SHARE) -> RunStats:
+    """Runs one sync of the index tops, of only `dirty` dirs if given
+
+    Deletions are planned during the walk and only run once it is over,
+    unless they look like a lost replica (see deletions_refused).
+    """
+    seen: dict = (dict((top, index.tree(top)) for top in index.tops)
+                  if deletions else None)
+    if trash is not None:
+        trash = os.path.join(os.path.abspath(trash),
+                             time.strftime('%Y-%m-%d_%H-%M-%S'))
+    deletes: list = []
+    if engine == 'async':
+        with stage('pipeline'):
+            stats: RunStats = asyncio.run(sync_pipeline(
+                index.tops, index, full_scan, max_in_flight, verify,
+                delta_threshold, seen, deletes, dirty
+            ))
+    else:
+        # Stages are pipelined: copy only counts the time spent outside
+        # of scanning and planning
+        listings = timed('scan', walk_trees(index.tops, index, full_scan,
+                                            dirty))
+        with stage('copy'):
+            pool: CopyPool = create_dirs_and_files(
+                timed('plan', plan_sync(listings, seen)), index,
+                copy_threads, verify, delta_threshold, deletes
+            )
+        stats: RunStats = RunStats(pool.files, pool.bytes, pool.elapsed)
+    if deletes:
+        with stage('delete'):
+            deleted: int = delete_paths(deletes, index, seen, trash,
+                                        max_deleted_share)
+    else:
+        deleted: int = 0
+    stats = stats._replace(
+        scanned=sum(len(index.tree(top)["entries"]) for top in index.tops),
+        written=stats.bytes
+    )
+    with stage('index'):
+        index.save(full_scan)
+    changed: str = f'{len(dirty)} changed dirs, ' if dirty is not None else ''
+    logger.info(f'Paths {index.tops} synced '
+                f'({changed}{transfer_stats(*stats[:3])}'
+                f'{f", {deleted} deleted" if deleted else ""})')
+
+    return stats
+
+
+class Inotify:
+    """Minimal ctypes binding of the Linux inotify API"""
+
+    def __init__(self) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd: int = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error: int = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        return None
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        wd: int = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                              mask)
+        if wd < 0:
+            error: int = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+        return wd
+
+    def read(self, timeout: float = None) -> list:
+        """Returns the pending (wd, mask, name) events, waiting if none"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        data: bytes = os.read(self.fd, 64 * 2 ** 10)
+        events: list = []
+        offset: int = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name: bytes = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+        return None
+
+
+watching: set = set()
+watching_lock: threading.Lock = threading.Lock()
+
+
+def watch_sync(index: 'SyncIndex', run, full_rescan_hours: float = 24,
+               debounce: float = 2.0, reconcile_minutes: float = 60) -> None:
+    """Syncs the directories inotify reports changed, until the process ends
+
+    Changes are collected until none arrive for `debounce` seconds (or for
+    ten times as long under constant writes), then only the changed
+    directories are rescanned and synced. A full reconcile runs every
+    `reconcile_minutes` and after an event queue overflow, catching what
+    the watches could not see. Later activations of the action return at
+    once while the watch runs.
+    """
+    with watching_lock:
+        if index.path in watching:
+            logger.debug(f'Paths {index.tops} already watched')
+            return None
+        watching.add(index.path)
+
+    try:
+        inotify: Inotify = Inotify()
+    except (OSError, AttributeError, TypeError):
+        logger.error('inotify is not available, watch mode disabled')
+        with watching_lock:
+            watching.discard(index.path)
+        run(index.scanned + full_rescan_hours * 3600 <= time.time())
+        return None
+
+    watches: dict = {}
+
+    def watch_tree(top: str, rel_dir: str) -> None:
+        try:
+            watches[inotify.add_watch(top + rel_dir)] = (top, rel_dir)
+            with os.scandir(top + rel_dir) as dir_entries:
+                subdirs: list = [dir_entry.name for dir_entry in dir_entries
+                                 if dir_entry.is_dir(follow_symlinks=False)]
+        except FileNotFoundError:
+            return None
+        except OSError as error:
+            logger.warning(f'Cannot watch "{top + rel_dir}": {error}')
+            return None
+        for name in subdirs:
+            watch_tree(top, rel_dir + os.sep + name)
+
+        return None
+
+    try:
+        for top in index.tops:
+            watch_tree(top, '')
+        logger.info(f'Paths {index.tops} watched ({len(watches)} dirs)')
+        run(index.scanned + full_rescan_hours * 3600 <= time.time())
+        reconcile_at: float = time.time() + reconcile_minutes * 60
+
+        while True:
+            dirty: set = set()
+            overflow: bool = False
+            events: list = inotify.read(max(0, reconcile_at - time.time()))
+            deadline: float = time.monotonic() + 10 * debounce
+            while events:
+                for wd, mask, name in events:
+                    if mask & IN_Q_OVERFLOW:
+                        overflow = True
+                        continue
+                    if wd not in watches:
+                        continue
+                    top, rel_dir = watches[wd]
+                    if mask & IN_IGNORED:
+                        del watches[wd]
+                        continue
+                    dirty.add(rel_dir)
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        watch_tree(top, rel_dir + os.sep + name)
+                if time.monotonic() >= deadline:
+                    break
+                events = inotify.read(debounce)
+
+            if overflow or time.time() >= reconcile_at:
+                logger.debug(f'Paths {index.tops} reconciled'
+                             f'{" (event overflow)" if overflow else ""}')
+                run(True)
+                reconcile_at = time.time() + reconcile_minutes * 60
+            elif dirty:
+                run(False, dirty)
+    finally:
+        inotify.close()
+        with watching_lock:
+            watching.discard(index.path)
+
+
+class FileEntry(NamedTuple):
+    is_dir: bool
+    size: int
+    mtime_ns: int
+    inode: int
+    digest: str = None
+
+
+class SyncIndex:
+    """Persistent file-state index of the trees synced together
+
+    Stored as zlib-compressed JSON in INDEX_DIR, one file per set of tops.
+    The names of a directory are reused while its mtime is unchanged, its
+    files being stat'ed again; the periodic full rescan lists everything.
+    The trees saved by the last run are the last-seen sets used to tell a
+    deleted path from a new one.
+    """
+
+    def __init__(self, tops: list) -> None:
+        self.tops: list = [os.path.abspath(top) for top in tops]
+        key: str = hashlib.sha1('\0'.join(sorted(self.tops)).encode())
+        self.path: str = os.path.join(INDEX_DIR,
+                                      key.hexdigest()[:16] + '.idx')
+        self.scanned: float = 0
+        self.trees: dict = {}
+        self.partial: set = load_partial()
+        self.load()
+
+        return None
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            with open(self.path, 'rb') as index_fp:
+                data: dict = json.loads(zlib.decompress(index_fp.read()))
+        except (OSError, ValueError, zlib.error):
+            logger.warning(f'Index "{self.path}" is corrupted, rebuilding')
+            return None
+
+        self.scanned = data["scanned"]
+        for top, tree in data["trees"].items():
+            self.trees[top] = {
+                "dirs": tree["dirs"],
+                "entries": dict((rel_path, FileEntry(*entry))
+                                for rel_path, entry in tree["entries"].items())
+            }
+        logger.debug(f'Index "{self.path}" loaded')
+
+        return None
+
+    def save(self, full_scan: bool) -> None:
+        if full_scan:
+            self.scanned = time.time()
+        data: bytes = json.dumps(
+            {"scanned": self.scanned, "trees": self.trees},
+            separators=(',', ':')
+        ).encode()
+
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        write_atomic(self.path, zlib.compress(data))
+        logger.debug(f'Index "{self.path}" saved')
+
+        return None
+
+    def tree(self, top: str) -> dict:
+        return self.trees.get(top, {"dirs": {}, "entries": {}})
+
+    def update(self, top: str, rel_path: str, digest: str = None) -> None:
+        """Records a path written by the sync
+
+        The path is added to the listing of its parent, whose saved mtime
+        is cleared: the write changed it, so it is listed again next run.
+        """
+        stat: os.stat_result = os.stat(top + rel_path)
+        tree: dict = self.trees[top]
+        tree["entries"][rel_path] = FileEntry(
+            os.path.isdir(top + rel_path), stat.st_size,
+            stat.st_mtime_ns, stat.st_ino, digest
+        )
+        rel_dir, name = rel_path.rsplit(os.sep, 1)
+        if rel_dir in tree["dirs"]:
+            tree["dirs"][rel_dir][0] = None
+            if name not in tree["dirs"][rel_dir][1]:
+                tree["dirs"][rel_dir][1].append(name)
+
+        return None
+
+    def remove(self, top: str, rel_path: str) -> None:
+        tree: dict = self.trees[top]
+        rel_dir, name = rel_path.rsplit(os.sep, 1)
+        if rel_dir in tree["dirs"]:
+            tree["dirs"][rel_dir][0] = None
+            if name in tree["dirs"][rel_dir][1]:
+                tree["dirs"][rel_dir][1].remove(name)
+        if tree["entries"].pop(rel_path).is_dir:
+            prefix: str = rel_path + os.sep
+            for path in [path for path in list(tree["entries"])
+                         if path.startswith(prefix)]:
+                del tree["entries"][path]
+            for path in [path for path in list(tree["dirs"])
+                         if path == rel_path or path.startswith(prefix)]:
+                del tree["dirs"][path]
+
+        return None
+
+
+def list_dir(top: str, rel_dir: str, cached: dict, tree: dict,
+             full_scan: bool, partial: set = None) -> dict:
+    """Lists one directory, reusing the cached names if it is unchanged
+
+    An unchanged directory mtime only means no name was added or removed,
+    so the files are still stat'ed to catch the ones written in place.
+    A file in `partial` (a copy cut short) is listed as dated 0, so it is
+    never the source and is copied again. The listing is recorded into
+    `tree`.
+    """
+    mtime_ns: int = os.stat(top + rel_dir).st_mtime_ns
+    cached_dir: list = cached["dirs"].get(rel_dir)
+    listing: dict = None
+
+    if (not full_scan and cached_dir is not None
+            and cached_dir[0] == mtime_ns):
+        listing = {}
+        for name in cached_dir[1]:
+            try:
+                stat: os.stat_result = os.stat(top + rel_dir + os.sep + name)
+            except FileNotFoundError:
+                logger.debug(f'"{top + rel_dir}" changed since listed')
+                listing = None
+                break
+            listing[name] = file_entry(
+                S_ISDIR(stat.st_mode), stat,
+                cached["entries"].get(rel_dir + os.sep + name)
+            )
+    if listing is None:
+        listing = {}
+        with os.scandir(top + rel_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                try:
+                    stat: os.stat_result = dir_entry.stat()
+                except OSError:
+                    logger.warning(f'Cannot stat "{dir_entry.path}"')
+                    continue
+                if dir_entry.is_symlink() and dir_entry.is_dir():
+                    logger.debug(f'Symlink to directory "{dir_entry.path}" '
+                                 'skipped')
+                    continue
+                listing[dir_entry.name] = file_entry(
+                    dir_entry.is_dir(), stat,
+                    cached["entries"].get(rel_dir + os.sep + dir_entry.name)
+                )
+
+    if partial:
+        for name, entry in listing.items():
+            if top + rel_dir + os.sep + name in partial:
+                listing[name] = entry._replace(mtime_ns=0)
+    tree["dirs"][rel_dir] = [mtime_ns, list(listing)]
+    for name, entry in listing.items():
+        tree["entries"][rel_dir + os.sep + name] = entry
+
+    return listing
+
+
+def file_entry(is_dir: bool, stat: os.stat_result,
+               old: FileEntry = None) -> FileEntry:
+    """Builds an index entry, keeping the old digest if the file is unchanged"""
+    entry: FileEntry = FileEntry(is_dir, stat.st_size, stat.st_mtime_ns,
+                                 stat.st_ino)
+    if old is not None and old[:3] == entry[:3]:
+        entry = entry._replace(digest=old.digest)
+
+    return entry
+
+
+def walk_trees(tops: list, index: 'SyncIndex', full_scan: bool = True,
+               dirty: set = None):
+    """Walks all tops in lockstep, one directory at a time
+
+    Yields (rel_dir, {top: {name: FileEntry}}) for every directory found in
+    any top, parents before children. Only the pending directories are held
+    in memory besides the index.
+
+    With `dirty`, the set of directories known to have changed, only those
+    are rescanned. Their ancestors are walked from the index and any other
+    subtree present in every top is carried over from it unvisited.
+    """
+    tops: list = [os.path.abspath(top) for top in tops]
+    cached: dict = dict((top, index.tree(top)) for top in tops)
+    trees: dict = dict((top, {"dirs": {}, "entries": {}}) for top in tops)
+    index.trees.update(trees)
+    stack: list = [('', tops)]
+    wanted: set = set()
+    for rel_dir in dirty or ():
+        while rel_dir not in wanted:
+            wanted.add(rel_dir)
+            rel_dir = rel_dir.rpartition(os.sep)[0]
+
+    while stack:
+        rel_dir, dir_tops = stack.pop()
+        if (dirty is not None and rel_dir not in wanted
+                and len(dir_tops) == len(tops)
+                and all(rel_dir in cached[top]["dirs"] for top in dir_tops)):
+            for top in dir_tops:
+                carry_over(cached[top], trees[top], rel_dir)
+            continue
+        listings: dict = {}
+        for top in dir_tops:
+            try:
+                listings[top] = list_dir(
+                    top, rel_dir, cached[top], trees[top],
+                    full_scan or dirty is not None and rel_dir in dirty,
+                    index.partial
+                )
+            except FileNotFoundError:
+                logger.debug(f'"{top + rel_dir}" removed since listed')
+        if not listings:
+            continue
+        yield rel_dir, listings
+
+        subdirs: dict = {}
+        for top, listing in listings.items():
+            for name, entry in listing.items():
+                if entry.is_dir:
+                    subdirs.setdefault(name, []).append(top)
+        for name, subdir_tops in reversed(subdirs.items()):
+            stack.append((rel_dir + os.sep + name, subdir_tops))
+
+    logger.debug(f'Paths {tops} scanned{" (full scan)" if full_scan else ""}')
+
+    return None
+
+
+def carry_over(cached: dict, tree: dict, rel_dir: str) -> None:
+    """Copies an unchanged directory subtree from the saved tree"""
+    stack: list = [rel_dir]
+    while stack:
+        rel_dir = stack.pop()
+        cached_dir: list = cached["dirs"].get(rel_dir)
+        if cached_dir is None:
+            continue
+        tree["dirs"][rel_dir] = cached_dir
+        for name in cached_dir[1]:
+            rel_path: str = rel_dir + os.sep + name
+            entry: FileEntry = cached["entries"].get(rel_path)
+            if entry is None:
+                continue
+            tree["entries"][rel_path] = entry
+            if entry.is_dir:
+                stack.append(rel_path)
+
+    return None
+
+
+class SyncOp(NamedTuple):
+    action: str
+    rel_path: str
+    src_top: str
+    dst_tops: tuple
+    entry: FileEntry
+
+
+def plan_sync(walk, seen: dict = None):
+    """Streams the operations bringing every top up to date
+
+    Consumes walk_trees output. Each name is looked up once per tree, so
+    planning is linear in the number of tops. The newest copy of a file
+    (the first top on a tie) is chosen once and is the source for all the
+    tops that lack it or have an older one, named together in one operation.
+
+    `seen` maps each top to its tree saved by the last run. A path missing
+    from a top that had it, and unchanged since then everywhere else, was
+    deleted: the operation deletes it from the other tops. A path changed
+    elsewhere since is copied back instead. The contents of a directory to
+    delete are not planned.
+
+    >>> a = {'d': FileEntry(True, 0, 0, 1), 'f': FileEntry(False, 1, 2e9, 2)}
+    >>> b = {'d': FileEntry(True, 0, 0, 3), 'f': FileEntry(False, 1, 1e9, 4)}
+    >>> c = {'f': FileEntry(False, 1, 2e9, 5)}
+    >>> [(op.action, op.rel_path, op.src_top, op.dst_tops)
+    ...  for op in plan_sync([('', {'A': a, 'B': b, 'C': c})])]
+    [('mkdir', '/d', 'A', ('C',)), ('copy', '/f', 'A', ('B',))]
+    >>> [(op.action, op.dst_tops) for op in plan_sync([('', {'A': a, 'B': a})])]
+    [('skip', ()), ('skip', ())]
+    >>> seen = {'A': {'entries': {'/f': b['f']}}, 'B': {'entries': {'/f': b['f']}}}
+    >>> [(op.action, op.rel_path, op.src_top, op.dst_tops) for op in plan_sync(
+    ...  [('', {'A': {}, 'B': {'f': b['f']}})], seen)]
+    [('delete', '/f', 'A', ('B',))]
+    >>> [(op.action, op.src_top, op.dst_tops) for op in plan_sync(
+    ...  [('', {'A': {}, 'B': {'f': a['f']}})], seen)]
+    [('copy', 'B', ('A',))]
+    """
+    tops: list = None
+    count: int = 0
+    deleted: set = set()
+
+    for rel_dir, listings in walk:
+        if tops is None:
+            tops = list(listings)
+        if rel_dir in deleted or (rel_dir and rel_dir.rsplit(os.sep, 1)[0]
+                                  in deleted):
+            # Still on disk: deletions run after the walk
+            deleted.add(rel_dir)
+            continue
+        for op in plan_directory(rel_dir, listings, tops, seen):
+            if op.action == 'delete' and op.entry.is_dir:
+                deleted.add(op.rel_path)
+            count += 1
+            yield op
+
+    logger.debug(f'Paths {tops} planned ({count} operations)')
+
+    return None
+
+
+def plan_directory(rel_dir: str, listings: dict, tops: list,
+                   seen: dict = None):
+    names: dict = {}
+    for listing in listings.values():
+        names.update(dict.fromkeys(listing))
+
+    for name in names:
+        if seen is not None:
+            op: SyncOp = plan_delete(rel_dir + os.sep + name, name, listings,
+                                     tops, seen)
+            if op is not None:
+                yield op
+                continue
+        src_top: str = None
+        src_entry: FileEntry = None
+        src_mtime: int = None
+        for top, listing in listings.items():
+            entry: FileEntry = listing.get(name)
+            if entry is None:
+                continue
+            mtime: int = round(entry.mtime_ns / 1e9)
+            if src_top is None or (not entry.is_dir and mtime > src_mtime):
+                src_top, src_entry, src_mtime = top, entry, mtime
+
+        stale: list = []
+        for top in tops:
+            if top == src_top:
+                continue
+            entry: FileEntry = listings.get(top, {}).get(name)
+            if entry is None or (not src_entry.is_dir
+                                 and round(entry.mtime_ns / 1e9) != src_mtime):
+                stale.append(top)
+
+        if not stale:
+            action: str = 'skip'
+        else:
+            action: str = 'mkdir' if src_entry.is_dir else 'copy'
+        yield SyncOp(action, rel_dir + os.sep + name, src_top, tuple(stale),
+                     src_entry)
+
+    return None
+
+
+def plan_delete(rel_path: str, name: str, listings: dict, tops: list,
+                seen: dict) -> SyncOp:
+    """Returns the delete operation if the path was deleted from a top
+
+    Only a top listing the parent directory counts: one missing it had the
+    whole directory planned at the parent level. The path is looked up on
+    disk again, as the listing may come from the index.
+
+    A file copied to a top is listed there by the next run even if the
+    write left the directory mtime unchanged (coarse timestamps):
+
+    >>> cwd, temp = os.getcwd(), tempfile.TemporaryDirectory()
+    >>> os.chdir(temp.name)
+    >>> os.mkdir('A'), os.mkdir('B')
+    (None, None)
+    >>> for name in ('a', 'b', 'c'):
+    ...     with open('A/' + name, 'w') as file:
+    ...         _ = file.write(name)
+    >>> stats = sync(['A', 'B'], deletions=True)
+    >>> with open('A/new', 'w') as file:
+    ...     _ = file.write('new')
+    >>> mtime_ns = os.stat('B').st_mtime_ns
+    >>> stats = sync(['A', 'B'], deletions=True)
+    >>> os.utime('B', ns=(mtime_ns, mtime_ns))
+    >>> stats = sync(['A', 'B'], deletions=True)
+    >>> sorted(os.listdir('A')) == sorted(os.listdir('B')) == ['a', 'b', 'c',
+    ...                                                         'new']
+    True
+    >>> os.chdir(cwd)
+    >>> temp.cleanup()
+    """
+    deleted_from: str = None
+    for top in tops:
+        if (top in listings and name not in listings[top]
+                and rel_path in seen.get(top, {}).get("entries", {})):
+            deleted_from = top
+            break
+    if deleted_from is None:
+        return None
+    if os.path.lexists(deleted_from + rel_path):
+        logger.debug(f'"{deleted_from + rel_path}" listed as deleted but '
+                     'still there')
+        return None
+
+    present: list = []
+    for top in tops:
+        entry: FileEntry = listings.get(top, {}).get(name)
+        if entry is None:
+            continue
+        old: FileEntry = seen.get(top, {}).get("entries", {}).get(rel_path)
+        if old is None or old.is_dir != entry.is_dir:
+            return None
+        if entry.is_dir:
+            if not subtree_unchanged(top, rel_path, seen[top]):
+                return None
+        elif old[:3] != entry[:3]:
+            return None
+        present.append(top)
+
+    return SyncOp('delete', rel_path, deleted_from, tuple(present),
+                  listings[present[0]][name])
+
+
+def subtree_unchanged(top: str, rel_dir: str, tree: dict) -> bool:
+    """Tells if a directory holds nothing new or changed since the saved tree
+
+    Deleting such a directory loses nothing the last run did not see.
+    """
+    with os.scandir(top + rel_dir) as dir_entries:
+        listed: list = list(dir_entries)
+    for dir_entry in listed:
+        rel_path: str = rel_dir + os.sep + dir_entry.name
+        old: FileEntry = tree["entries"].get(rel_path)
+        if old is None or old.is_dir != dir_entry.is_dir():
+            return False
+        if old.is_dir:
+            if not subtree_unchanged(top, rel_path, tree):
+                return False
+        else:
+            stat: os.stat_result = dir_entry.stat()
+            if (old.size, old.mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                return False
+
+    return True
+
+
+def delete_path(top: str, rel_path: str, trash: str = None) -> None:
+    """Deletes a synced path, or moves it under `trash` if set"""
+    path: str = top + rel_path
+    if trash is not None:
+        trash_path: str = os.path.join(
+            trash, os.path.splitdrive(top)[1].lstrip(os.sep) + rel_path
+        )
+        os.makedirs(os.path.dirname(trash_path), exist_ok=True)
+        shutil.move(path, trash_path)
+    elif os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+    logger.debug(f'"{path}" deleted{" to trash" if trash else ""}')
+
+    return None
+
+
+def delete_paths(deletes: list, index: 'SyncIndex', seen: dict,
+                 trash: str = None,
+                 max_deleted_share: float = MAX_DELETED_SHARE) -> int:
+    """Runs the delete operations planned by a sync, once its walk is over
+
+    If they are refused, the deleted paths are kept in the index, so the
+    next runs neither delete nor copy them back. Returns the number of
+    paths deleted.
+    """
+    refused: str = deletions_refused(deletes, index, seen,
+                                     max_deleted_share)
+    if refused is not None:
+        logger.error(f'Deletions not propagated: {refused}')
+        for top, roots in deleted_roots(deletes).items():
+            for rel_path in subtree_paths(seen[top]["entries"], roots):
+                index.trees[top]["entries"][rel_path] = (
+                    seen[top]["entries"][rel_path]
+                )
+        return 0
+
+    for op in deletes:
+        for dst_top in op.dst_tops:
+            delete_path(dst_top, op.rel_path, trash)
+            index.remove(dst_top, op.rel_path)
+
+    return len(deletes)
+
+
+def deletions_refused(deletes: list, index: 'SyncIndex', seen: dict,
+                      max_deleted_share: float = MAX_DELETED_SHARE) -> str:
+    """Tells why the deletions look like a lost replica rather than
+    deleted files, or returns None
+
+    They are refused if a top they come from lists nothing after having
+    entries (an unmounted or wiped disk), or if more than
+    `max_deleted_share` of its saved paths vanished.
+
+    >>> seen = {'A': {'entries': dict.fromkeys(('/d', '/d/f', '/e', '/g'))}}
+    >>> index = SyncIndex.__new__(SyncIndex)
+    >>> index.trees = {'A': {'entries': dict.fromkeys(('/e', '/g'))}}
+    >>> delete = SyncOp('delete', '/d', 'A', ('B',), FileEntry(True, 0, 0, 1))
+    >>> print(deletions_refused([delete], index, seen))
+    None
+    >>> print(deletions_refused([delete], index, seen, 0.4))
+    2 of 4 paths vanished from "A" (more than 40%)
+    >>> index.trees = {'A': {'entries': {}}}
+    >>> print(deletions_refused([delete], index, seen))
+    "A" lists nothing (not mounted?)
+    """
+    for top, roots in deleted_roots(deletes).items():
+        old: dict = seen[top]["entries"]
+        if not index.trees[top]["entries"]:
+            return f'"{top}" lists nothing (not mounted?)'
+        vanished: int = sum(1 for _ in subtree_paths(old, roots))
+        if vanished > max_deleted_share * len(old):
+            return (f'{vanished} of {len(old)} paths vanished from "{top}" '
+                    f'(more than {max_deleted_share:.0%})')
+
+    return None
+
+
+def deleted_roots(deletes: list) -> dict:
+    """Maps each top deletions come from to the paths deleted from it"""
+    roots: dict = {}
+    for op in deletes:
+        roots.setdefault(op.src_top, set()).add(op.rel_path)
+
+    return roots
+
+
+def subtree_paths(entries: dict, roots: set):
+    """Yields the paths of `entries` at or under one of `roots`"""
+    for rel_path in entries:
+        parent: str = rel_path
+        while parent:
+            if parent in roots:
+                yield rel_path
+                break
+            parent = parent.rpartition(os.sep)[0]
+
+    return None
+
+
+class CopyPool:
+    """Copies files on a thread pool with a bounded number of queued copies
+
+    The first error stops new copies and is raised by close().
+    """
+
+    def __init__(self, threads: int = 4) -> None:
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            threads, thread_name_prefix='copy'
+        )
+        self.slots: threading.Semaphore = threading.Semaphore(4 * threads)
+        self.lock: threading.Lock = threading.Lock()
+        self.errors: list = []
+        self.files: int = 0
+        self.bytes: int = 0
+        self.started: float = time.perf_counter()
+        self.elapsed: float = 0
+
+        return None
+
+    def submit(self, func, *args, size: int = 0) -> None:
+        if self.errors:
+            return None
+        self.slots.acquire()
+        self.executor.submit(profiled(self.run), func, args, size)
+
+        return None
+
+    def run(self, func, args: tuple, size: int) -> None:
+        try:
+            if not self.errors:
+                func(*args)
+                with self.lock:
+                    self.files += 1
+                    self.bytes += size
+        except BaseException as error:
+            logger.error(f'Copy {args} failed: {error!r}')
+            with self.lock:
+                self.errors.append(error)
+        finally:
+            self.slots.release()
+
+        return None
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.elapsed = time.perf_counter() - self.started
+        if self.errors:
+            raise self.errors[0]
+
+        return None
+
+    def stats(self) -> str:
+        return transfer_stats(self.files, self.bytes, self.elapsed)
+
+
+def transfer_stats(files: int, size: int, elapsed: float) -> str:
+    """Formats transfer counters
+
+    >>> transfer_stats(10, 2 ** 21, 2.0)
+    '10 files, 2.0 MiB in 2.00 s, 5.0 files/s, 1.0 MiB/s'
+    """
+    per_second: float = 1 / elapsed if elapsed else 0
+    return (f'{files} files, {size / 2 ** 20:.1f} MiB in {elapsed:.2f} s, '
+            f'{files * per_second:.1f} files/s, '
+            f'{size * per_second / 2 ** 20:.1f} MiB/s')
+
+
+def reflink(src_fd: int, dst_fd: int, size: int) -> None:
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'ioctl is not available')
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+    return None
+
+
+def copy_range(src_fd: int, dst_fd: int, size: int) -> None:
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    offset: int = 0
+    while offset < size:
+        copied: int = os.copy_file_range(src_fd, dst_fd, size - offset,
+                                         offset, offset)
+        if not copied:
+            break
+        offset += copied
+
+    return None
+
+
+def send_file(src_fd: int, dst_fd: int, size: int) -> None:
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, 'sendfile is not available')
+    offset: int = 0
+    while offset < size:
+        sent: int = os.sendfile(dst_fd, src_fd, offset, size - offset)
+        if not sent:
+            break
+        offset += sent
+
+    return None
+
+
+def buffered_copy(src_fd: int, dst_fd: int, size: int) -> None:
+    while chunk := os.read(src_fd, COPY_BUFFER_SIZE):
+        os.write(dst_fd, chunk)
+
+    return None
+
+
+COPY_METHODS: tuple = (reflink, copy_range, send_file)
+COPY_FALLBACK_ERRNOS: set = {
+    errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+    errno.ENOSYS, errno.EBADF, errno.ETXTBSY, errno.EPERM
+}
+unsupported_copies: set = set()
+
+
+def copy_file(src_path: str, dst_path: str) -> None:
+    """Copies data and metadata like shutil.copy2, in the kernel if possible
+
+    Tries a reflink (FICLONE), then os.copy_file_range, then os.sendfile,
+    falling back to a buffered copy. A method that fails for a pair of
+    devices is not tried for that pair again.
+    """
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        size: int = os.fstat(src_fd).st_size
+        devices: tuple = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+
+        for method in COPY_METHODS:
+            if (method, devices) in unsupported_copies:
+                continue
+            try:
+                method(src_fd, dst_fd, size)
+                break
+            except OSError as error:
+                if error.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+                logger.debug(f'{method.__name__} is not supported for '
+                             f'devices {devices}: {error}')
+                unsupported_copies.add((method, devices))
+                os.ftruncate(dst_fd, 0)
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+        else:
+            buffered_copy(src_fd, dst_fd, size)
+
+    shutil.copystat(src_path, dst_path)
+
+    return None
+
+
+def tee_copy(src_path: str, dst_paths: list, expected: str = None) -> str:
+    """Copies one source to several destinations, reading and hashing it once
+
+    Each copy is written to a temporary file renamed over its destination
+    only if the source matches `expected`, its digest recorded when the
+    same size and mtime were last seen. Returns the digest.
+    """
+    digest: ChunkedHash = ChunkedHash()
+    temp_paths: list = []
+    try:
+        for dst_path in dst_paths:
+            dirname, basename = os.path.split(dst_path)
+            fd, temp_path = tempfile.mkstemp(prefix=f'.{basename}-',
+                                             dir=dirname)
+            os.close(fd)
+            temp_paths.append(temp_path)
+        with contextlib.ExitStack() as stack:
+            src = stack.enter_context(open(src_path, 'rb'))
+            dsts: list = [stack.enter_context(open(temp_path, 'wb'))
+                          for temp_path in temp_paths]
+            while chunk := src.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+                for dst in dsts:
+                    dst.write(chunk)
+        if expected is not None and digest.hexdigest() != expected:
+            logger.error(f'"{src_path}" changed without a new mtime, '
+                         'possible silent corruption: not copied')
+            raise ValueError(f'Digest mismatch: {src_path!r}')
+        for temp_path, dst_path in zip(temp_paths, dst_paths):
+            shutil.copystat(src_path, temp_path)
+            os.replace(temp_path, dst_path)
+    except BaseException:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        raise
+
+    return digest.hexdigest()
+
+
+def signature_path(dst_path: str) -> str:
+    key: str = hashlib.sha1(os.path.abspath(dst_path).encode()).hexdigest()
+    return os.path.join(INDEX_DIR, 'signatures', key + '.sig')
+
+
+def partial_path(dst_path: str) -> str:
+    key: str = hashlib.sha1(os.path.abspath(dst_path).encode()).hexdigest()
+    return os.path.join(INDEX_DIR, 'partial', key)
+
+
+def mark_partial(dst_path: str) -> None:
+    """Records that a destination is being written in place
+
+    Until unmark_partial, a run cut short leaves the destination newer than
+    its source but incomplete; the next sync copies it again:
+
+    >>> cwd, temp = os.getcwd(), tempfile.TemporaryDirectory()
+    >>> os.chdir(temp.name)
+    >>> os.mkdir('A'), os.mkdir('B')
+    (None, None)
+    >>> with open('A/f', 'w') as file:
+    ...     _ = file.write('complete')
+    >>> stats = sync(['A', 'B'])
+    >>> mark_partial('B/f')
+    >>> with open('B/f', 'w') as file:
+    ...     _ = file.write('comp')
+    >>> os.utime('B/f', (time.time() + 2, time.time() + 2))
+    >>> stats = sync(['A', 'B'])
+    >>> open('A/f').read(), open('B/f').read()
+    ('complete', 'complete')
+    >>> os.listdir(os.path.join(INDEX_DIR, 'partial'))
+    []
+    >>> os.chdir(cwd)
+    >>> temp.cleanup()
+    """
+    os.makedirs(os.path.dirname(partial_path(dst_path)), exist_ok=True)
+    write_atomic(partial_path(dst_path), os.path.abspath(dst_path).encode())
+
+    return None
+
+
+def unmark_partial(dst_path: str) -> None:
+    try:
+        os.unlink(partial_path(dst_path))
+    except FileNotFoundError:
+        pass
+
+    return None
+
+
+def load_partial() -> set:
+    """Returns the destinations left incomplete by an interrupted copy"""
+    partial: set = set()
+    try:
+        names: list = os.listdir(os.path.join(INDEX_DIR, 'partial'))
+    except FileNotFoundError:
+        return partial
+    for name in names:
+        try:
+            with open(os.path.join(INDEX_DIR, 'partial', name), 'rb') as fp:
+                partial.add(os.fsdecode(fp.read()))
+        except OSError:
+            continue
+    if partial:
+        logger.warning(f'{len(partial)} interrupted copies to redo')
+
+    return partial
+
+
+def load_signatures(dst_path: str, stat: os.stat_result) -> list:
+    """Returns the saved block signatures if the file has not changed since"""
+    try:
+        with open(signature_path(dst_path), 'rb') as signature_fp:
+            data: bytes = signature_fp.read()
+        size, mtime_ns, block_size = SIGNATURE_HEADER.unpack_from(data)
+    except (OSError, struct.error):
+        return None
+    if (size, mtime_ns, block_size) != (stat.st_size, stat.st_mtime_ns,
+                                         DELTA_BLOCK_SIZE):
+        return None
+
+    return list(SIGNATURE_RECORD.iter_unpack(data[SIGNATURE_HEADER.size:]))
+
+
+def save_signatures(dst_path: str, signatures: list) -> None:
+    stat: os.stat_result = os.stat(dst_path)
+    os.makedirs(os.path.dirname(signature_path(dst_path)), exist_ok=True)
+    write_atomic(signature_path(dst_path), SIGNATURE_HEADER.pack(
+        stat.st_size, stat.st_mtime_ns, DELTA_BLOCK_SIZE
+    ) + b''.join(SIGNATURE_RECORD.pack(*signature)
+                 for signature in signatures))
+
+    return None
+
+
+def block_signature(block: bytes) -> tuple:
+    return zlib.adler32(block), hashlib.blake2b(block, digest_size=8).digest()
+
+
+def delta_copy(src_path: str, dst_path: str) -> int:
+    """Rewrites in place only the destination blocks that differ
+
+    Destination blocks are described by a weak (Adler-32) and a strong
+    (BLAKE2b) checksum, saved after each run so an unchanged destination
+    is not read again. A source block is compared by its weak checksum
+    first and the strong one only on a weak match. Blocks are compared at
+    the same offsets: rolling the weak checksum byte by byte to find
+    shifted blocks would cost more in Python than rewriting them.
+    Returns the number of bytes written.
+    """
+    signatures: list = load_signatures(dst_path, os.stat(dst_path))
+    new_signatures: list = []
+    written: int = 0
+
+    with open(src_path, 'rb') as src, open(dst_path, 'r+b') as dst:
+        block_number: int = 0
+        while block := src.read(DELTA_BLOCK_SIZE):
+            if signatures is not None:
+                old: tuple = (signatures[block_number]
+                              if block_number < len(signatures) else None)
+            else:
+                dst.seek(block_number * DELTA_BLOCK_SIZE)
+                old_block: bytes = dst.read(DELTA_BLOCK_SIZE)
+                old: tuple = block_signature(old_block) if old_block else None
+
+            weak: int = zlib.adler32(block)
+            signature: tuple = None
+            if old is not None and old[0] == weak:
+                signature = (weak, hashlib.blake2b(block,
+                                                   digest_size=8).digest())
+            if signature is None or signature != old:
+                dst.seek(block_number * DELTA_BLOCK_SIZE)
+                dst.write(block)
+                written += len(block)
+                signature = signature or block_signature(block)
+            new_signatures.append(signature)
+            block_number += 1
+        dst.truncate(src.tell())
+
+    shutil.copystat(src_path, dst_path)
+    save_signatures(dst_path, new_signatures)
+
+    return written
+
+
+def copy_entry(op: 'SyncOp', index: 'SyncIndex', verify: bool,
+               delta_threshold: int = None) -> None:
+    """Brings every destination of a copy operation up to date
+
+    Several destinations, or a verified copy, are written in one pass over
+    the source (tee_copy). A single stale destination is updated by block
+    delta when large, otherwise copied by the fastest kernel method.
+    Large destinations are marked partial while written (see
+    mark_partial).
+    """
+    src_path: str = op.src_top + op.rel_path
+    dst_paths: list = [dst_top + op.rel_path for dst_top in op.dst_tops]
+    if delta_threshold is not None and op.entry.size >= delta_threshold:
+        partial: list = dst_paths
+    else:
+        partial: list = [dst_path for dst_path in dst_paths
+                         if dst_path in index.partial]
+    for dst_path in partial:
+        mark_partial(dst_path)
+    if verify or len(dst_paths) > 1:
+        digest: str = tee_copy(src_path, dst_paths,
+                               op.entry.digest if verify else None)
+        if verify:
+            index.trees[op.src_top]["entries"][op.rel_path] = (
+                op.entry._replace(digest=digest)
+            )
+        for dst_top in op.dst_tops:
+            index.update(dst_top, op.rel_path, digest)
+    elif (delta_threshold is not None and op.entry.size >= delta_threshold
+          and os.path.isfile(dst_paths[0])):
+        written: int = delta_copy(src_path, dst_paths[0])
+        logger.debug(f'"{dst_paths[0]}" updated by delta '
+                     f'({written} of {op.entry.size} bytes written)')
+        index.update(op.dst_tops[0], op.rel_path)
+    else:
+        copy_file(src_path, dst_paths[0])
+        index.update(op.dst_tops[0], op.rel_path)
+    for dst_path in partial:
+        unmark_partial(dst_path)
+        index.partial.discard(dst_path)
+
+    return None
+
+
+def create_dirs_and_files(plan, index: 'SyncIndex', threads: int = 4,
+                          verify: bool = False, delta_threshold: int = None,
+                          deletes: list = None) -> CopyPool:
+    """Runs the plan: directories inline, files on a pool
+
+    Directories arrive before their contents, so every copy is submitted
+    after its destination directory exists. Delete operations are left in
+    `deletes` for delete_paths.
+    """
+    pool: CopyPool = CopyPool(threads)
+    try:
+        for op in plan:
+            if op.action == 'delete':
+                if deletes is not None:
+                    deletes.append(op)
+            elif op.action == 'mkdir':
+                for dst_top in op.dst_tops:
+                    os.makedirs(dst_top + op.rel_path, exist_ok=True)
+                    index.update(dst_top, op.rel_path)
+            elif op.action == 'copy':
+                pool.submit(copy_entry, op, index, verify, delta_threshold,
+                            size=op.entry.size * len(op.dst_tops))
+    finally:
+        pool.close()
+
+    logger.debug(f'Plan done ({pool.stats()})')
+
+    return pool
+
+
+async def sync_pipeline(tops: list, index: 'SyncIndex', full_scan: bool,
+                        max_in_flight: int = 64, verify: bool = False,
+                        delta_threshold: int = None, seen: dict = None,
+                        deletes: list = None, dirty: set = None) -> RunStats:
+    """Scan, diff and copy stages joined by bounded asyncio queues
+
+    Every file operation runs on a thread pool and up to `max_in_flight`
+    of them are in progress at once, which hides per-file syscall latency
+    on trees of many small files. Delete operations are left in `deletes`
+    for delete_paths, and the contents of directories to delete skipped:
+
+    >>> import shutil
+    >>> cwd, temp = os.getcwd(), tempfile.TemporaryDirectory()
+    >>> os.chdir(temp.name)
+    >>> for name in ('d/sub/f', 'd/sub/deeper/f', 'e/f1', 'e/f2', 'e/f3',
+    ...              'e/f4'):
+    ...     os.makedirs(os.path.dirname('A/' + name), exist_ok=True)
+    ...     with open('A/' + name, 'w') as file:
+    ...         _ = file.write(name)
+    >>> os.mkdir('B')
+    >>> stats = sync(['A', 'B'], engine='async', deletions=True)
+    >>> shutil.rmtree('A/d')
+    >>> stats = sync(['A', 'B'], engine='async', deletions=True)
+    >>> stats = sync(['A', 'B'], engine='async', deletions=True)
+    >>> sorted(os.listdir('A')), sorted(os.listdir('B'))
+    (['e'], ['e'])
+    >>> os.chdir(cwd)
+    >>> temp.cleanup()
+    """
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    executor: ThreadPoolExecutor = ThreadPoolExecutor(
+        max_in_flight, thread_name_prefix='sync'
+    )
+    listings_queue: asyncio.Queue = asyncio.Queue(SCAN_QUEUE_SIZE)
+    ops_queue: asyncio.Queue = asyncio.Queue(2 * max_in_flight)
+    counters: dict = {"files": 0, "bytes": 0}
+    started: float = time.perf_counter()
+    next_listing = profiled(next)
+    make_dirs = profiled(os.makedirs)
+    copy_op = profiled(copy_entry)
+
+    async def scan() -> None:
+        walk = walk_trees(tops, index, full_scan, dirty)
+        while (item := await loop.run_in_executor(executor, next_listing,
+                                                  walk, None)) is not None:
+            await listings_queue.put(item)
+        await listings_queue.put(None)
+
+        return None
+
+    async def diff() -> None:
+        all_tops: list = None
+        deleted: set = set()
+        while (item := await listings_queue.get()) is not None:
+            rel_dir, listings = item
+            if all_tops is None:
+                all_tops = list(listings)
+            if rel_dir in deleted or (rel_dir and rel_dir.rsplit(os.sep, 1)[0]
+                                      in deleted):
+                # Still on disk: deletions run after the pipeline
+                deleted.add(rel_dir)
+                continue
+            for op in plan_directory(rel_dir, listings, all_tops, seen):
+                if op.action == 'delete':
+                    if op.entry.is_dir:
+                        deleted.add(op.rel_path)
+                    if deletes is not None:
+                        deletes.append(op)
+                elif op.action == 'mkdir':
+                    for dst_top in op.dst_tops:
+                        await loop.run_in_executor(
+                            executor, functools.partial(
+                                make_dirs, dst_top + op.rel_path,
+                                exist_ok=True
+                            )
+                        )
+                        index.update(dst_top, op.rel_path)
+                elif op.action == 'copy':
+                    await ops_queue.put(op)
+        for _ in range(max_in_flight):
+            await ops_queue.put(None)
+
+        return None
+
+    async def copy() -> None:
+        while (op := await ops_queue.get()) is not None:
+            await loop.run_in_executor(executor, copy_op, op, index,
+                                       verify, delta_threshold)
+            counters["files"] += 1
+            counters["bytes"] += op.entry.size * len(op.dst_tops)
+
+        return None
+
+    tasks: list = [asyncio.ensure_future(scan()),
+                   asyncio.ensure_future(diff())]
+    tasks += [asyncio.ensure_future(copy()) for _ in range(max_in_flight)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+    return RunStats(counters["files"], counters["bytes"],
+                    time.perf_counter() - started)
+
+
+def archive(from_path: str, to_path: str = os.getcwd(),
+            format: str = 'zip', method: str = 'deflate', level: int = None,
+            processes: int = None, incremental: bool = False,
+            full_every: int = 7, verify: bool = False) -> RunStats:
+    from_path = os.path.normpath(from_path)
+    to_path = os.path.normpath(to_path)
+
+    check_paths(from_path, to_path)
+    if format not in ARCHIVE_FORMATS:
+        logger.critical(f'Unknown archive format: {format!r}')
+        raise ValueError(f'Unknown archive format: {format!r}')
+    elif format == 'zip' and method not in ZIP_METHODS:
+        logger.critical(f'Unknown compression method: {method!r}')
+        raise ValueError(f'Unknown compression method: {method!r}')
+    elif format == 'tar.zst' and zstd is None:
+        logger.warning('zstd module not found, using tar.xz instead')
+        format = 'tar.xz'
+    if level is None:
+        level = ARCHIVE_FORMATS[format]
+
+    archive_path: str = (to_path + os.sep
+                         + time.strftime('%d.%m.%y_%H-%M-%S') + '.' + format)
+    with stage('scan'):
+        dirs, tree_files, files, previous = select_archive_files(
+            from_path, to_path, incremental, full_every
+        )
+
+    with stage('compress'):
+        if format == 'zip':
+            stats: dict = write_zip(archive_path, from_path, dirs, files,
+                                    method, level, processes)
+        else:
+            stats: dict = write_tar(archive_path, from_path, dirs, files,
+                                    format, level, processes)
+
+    if incremental or verify:
+        with stage('manifest'):
+            write_manifest(archive_path, from_path, dirs, tree_files, files,
+                           stats["digests"], previous)
+
+    ratio: float = stats["written"] / stats["read"] if stats["read"] else 1
+    logger.info(f'Archived from "{from_path}" to "{to_path}" '
+                f'({stats["files"]} files, {stats["read"] / 2 ** 20:.1f} MiB '
+                f'-> {stats["written"] / 2 ** 20:.1f} MiB, ratio {ratio:.2f}, '
+                f'{stats["elapsed"]:.2f} s'
+                f'{", incremental" if previous is not None else ""})')
+
+    return RunStats(stats["files"], stats["read"], stats["elapsed"],
+                    len(tree_files), stats["written"])
+
+
+def select_archive_files(from_path: str, to_path: str,
+                         incremental: bool = False,
+                         full_every: int = 7) -> tuple:
+    """Scans the tree and picks the files the next archive holds
+
+    Returns (dirs, tree_files, files, previous): an incremental archive
+    holds the files changed since the previous manifest, unless the chain
+    is `full_every` long and a full archive is due (previous is None).
+    """
+    dirs, tree_files = scan_archive_tree(from_path)
+    files: dict = tree_files
+
+    previous: dict = None
+    if incremental:
+        previous = latest_manifest(to_path, from_path)
+        if previous is not None and previous["depth"] >= full_every:
+            previous = None
+        if previous is not None:
+            old_files: dict = previous["files"]
+            files = dict(
+                (name, stat) for name, stat in files.items()
+                if old_files.get(name, [None, None])[:2]
+                != [stat.st_size, stat.st_mtime_ns]
+            )
+
+    return dirs, tree_files, files, previous
+
+
+def archive_and_del(from_path: str, to_path: str = os.getcwd(),
+                    **options) -> RunStats:
+    stats: RunStats = archive(from_path, to_path, **options)
+    with stage('delete'):
+        shutil.rmtree(from_path, True)
+
+    logger.info(f'Removed tree "{from_path}"')
+
+    return stats
+
+
+class OrderedPool:
+    """Process pool handing results back in submission order
+
+    At most 2 tasks per process are pending; submit() blocks on the oldest
+    one beyond that, which keeps memory bounded.
+    """
+
+    def __init__(self, processes: int = None) -> None:
+        processes = processes or os.cpu_count() or 1
+        self.executor: ProcessPoolExecutor = ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context('spawn')
+        )
+        self.max_pending: int = 2 * processes
+        self.window: collections.deque = collections.deque()
+
+        return None
+
+    def submit(self, consume, func=None, *args) -> None:
+        """Calls consume(func(*args)) in order; func None passes None"""
+        future = None if func is None else self.executor.submit(func, *args)
+        self.window.append((consume, future))
+        while len(self.window) > self.max_pending:
+            self.consume()
+
+        return None
+
+    def consume(self) -> None:
+        consume, future = self.window.popleft()
+        consume(None if future is None else future.result())
+
+        return None
+
+    def close(self) -> None:
+        while self.window:
+            self.consume()
+        self.executor.shutdown()
+
+        return None
+
+    def cancel(self) -> None:
+        self.window.clear()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+        return None
+
+
+def scan_archive_tree(from_path: str) -> tuple:
+    """Returns ({dir name: stat}, {file name: stat}) with "/" separators
+
+    Symlinks to files are followed; other special files are left out, as
+    archives only hold file contents.
+    """
+    dirs: dict = {}
+    files: dict = {}
+
+    for dirpath, dirnames, filenames in os.walk(from_path):
+        dirnames.sort()
+        rel_dir: str = os.path.relpath(dirpath, from_path)
+        prefix: str = '' if rel_dir == '.' else rel_dir.replace(os.sep, '/')
+        if prefix:
+            dirs[prefix] = os.stat(dirpath)
+
+        for filename in sorted(filenames):
+            path: str = os.path.join(dirpath, filename)
+            try:
+                stat: os.stat_result = os.stat(path)
+            except OSError:
+                logger.warning(f'Cannot stat "{path}"')
+                continue
+            if not S_ISREG(stat.st_mode):
+                logger.debug(f'Special file "{path}" skipped')
+                continue
+            files[(prefix + '/' if prefix else '') + filename] = stat
+
+    return dirs, files
+
+
+def archive_chunks(from_path: str, dirs: dict, files: dict):
+    """Yields (name, path, stat, offset, length, last) archive work units
+
+    Directories are single units without a path to read. Files are cut into
+    ARCHIVE_CHUNK_SIZE pieces.
+    """
+    for name, stat in dirs.items():
+        yield name + '/', None, stat, 0, 0, True
+
+    for name, stat in files.items():
+        path: str = os.path.join(from_path, *name.split('/'))
+        offset: int = 0
+        while True:
+            length: int = min(ARCHIVE_CHUNK_SIZE, stat.st_size - offset)
+            last: bool = offset + length >= stat.st_size
+            yield name, path, stat, offset, length, last
+            if last:
+                break
+            offset += length
+
+
+def compress_chunk(path: str, offset: int, length: int, last: bool,
+                   method: str, level: int) -> tuple:
+    """Reads and compresses one piece of a file in a worker process
+
+    Deflate pieces use the preceding 32 KiB as a dictionary and end with a
+    sync flush, so their concatenation is one valid deflate stream.
+    Returns (data, crc32, bytes read, piece digest): a file shrunk since
+    the scan gives a short piece.
+    """
+    dictionary: bytes = b''
+    with open(path, 'rb') as file:
+        if offset and method == 'deflate':
+            start: int = max(0, offset - DEFLATE_WINDOW)
+            file.seek(start)
+            dictionary = file.read(offset - start)
+        else:
+            file.seek(offset)
+        data: bytes = file.read(length)
+
+    crc: int = zlib.crc32(data)
+    digest: bytes = chunk_digest(data)
+    size: int = len(data)
+    if method == 'deflate':
+        if dictionary:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15,
+                                          zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+        )
+
+    return data, crc, size, digest
+
+
+def write_zip(archive_path: str, from_path: str, dirs: dict, files: dict,
+              method: str, level: int, processes: int = None) -> dict:
+    """Compresses the tree on a process pool and writes entries in order
+
+    The archive is written next to its final name and renamed when done.
+    """
+    started: float = time.perf_counter()
+    stats: dict = {"files": 0, "read": 0, "written": 0, "digests": {}}
+    temp_path: str = archive_path + '.part'
+    entry_state: list = [0, 0, None]
+    zip_writer: ZipWriter = ZipWriter(temp_path)
+    pool: OrderedPool = OrderedPool(processes)
+
+    def write_directory(name: str, stat: os.stat_result):
+        def consume(result) -> None:
+            zip_writer.start(name, stat, 'store')
+            zip_writer.finish(0, 0)
+
+            return None
+        return consume
+
+    def write_chunk(name: str, stat: os.stat_result, offset: int,
+                    last: bool):
+        def consume(result: tuple) -> None:
+            if offset == 0:
+                zip_writer.start(name, stat, method)
+                entry_state[:] = [0, 0, ChunkedHash()]
+            data, crc, size, digest = result
+            zip_writer.write(data)
+            entry_state[0] = crc32_combine(entry_state[0], crc, size)
+            entry_state[1] += size
+            entry_state[2].add_piece(digest)
+            stats["read"] += size
+            if last:
+                zip_writer.finish(entry_state[0], entry_state[1])
+                stats["digests"][name] = entry_state[2].hexdigest()
+                stats["files"] += 1
+
+            return None
+        return consume
+
+    try:
+        for name, path, stat, offset, length, last in archive_chunks(
+                from_path, dirs, files):
+            if path is None:
+                pool.submit(write_directory(name, stat))
+            else:
+                pool.submit(write_chunk(name, stat, offset, last),
+                            compress_chunk, path, offset, length, last,
+                            method, level)
+        pool.close()
+        zip_writer.close()
+    except BaseException:
+        pool.cancel()
+        zip_writer.fp.close()
+        os.unlink(temp_path)
+        raise
+
+    os.replace(temp_path, archive_path)
+    stats["written"] = os.path.getsize(archive_path)
+    stats["elapsed"] = time.perf_counter() - started
+
+    return stats
+
+
+def compress_block(data: bytes, format: str, level: int) -> bytes:
+    """Compresses a piece of a tar stream as a standalone member
+
+    Gzip members, xz streams and zstd frames can all be concatenated, so
+    the pieces are compressed independently in worker processes.
+    """
+    if format == 'tar.gz':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    elif format == 'tar.xz':
+        return lzma.compress(data, preset=level)
+    elif zstd.__name__ == 'zstandard':
+        return zstd.ZstdCompressor(level=level).compress(data)
+    return zstd.compress(data, level=level)
+
+
+class TarSink:
+    """File-like tar stream target cutting the stream into pool tasks"""
+
+    def __init__(self, fp, pool: OrderedPool, format: str,
+                 level: int) -> None:
+        self.fp = fp
+        self.pool: OrderedPool = pool
+        self.format: str = format
+        self.level: int = level
+        self.buffer: bytearray = bytearray()
+        self.read: int = 0
+
+        return None
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        if len(self.buffer) >= ARCHIVE_CHUNK_SIZE:
+            self.submit()
+
+        return len(data)
+
+    def submit(self) -> None:
+        self.read += len(self.buffer)
+        self.pool.submit(self.fp.write, compress_block, bytes(self.buffer),
+                         self.format, self.level)
+        self.buffer = bytearray()
+
+        return None
+
+    def close(self) -> None:
+        if self.buffer:
+            self.submit()
+        self.pool.close()
+
+        return None
+
+
+class HashingReader:
+    """Read-only file wrapper hashing everything read through it"""
+
+    def __init__(self, file) -> None:
+        self.file = file
+        self.digest: ChunkedHash = ChunkedHash()
+
+        return None
+
+    def read(self, size: int = -1) -> bytes:
+        data: bytes = self.file.read(size)
+        self.digest.update(data)
+
+        return data
+
+
+def write_tar(archive_path: str, from_path: str, dirs: dict, files: dict,
+              format: str, level: int, processes: int = None) -> dict:
+    """Writes a tar stream compressed in pieces on a process pool"""
+    started: float = time.perf_counter()
+    stats: dict = {"files": 0, "read": 0, "written": 0, "digests": {}}
+    temp_path: str = archive_path + '.part'
+    pool: OrderedPool = OrderedPool(processes)
+
+    try:
+        with open(temp_path, 'wb') as archive_fp:
+            sink: TarSink = TarSink(archive_fp, pool, format, level)
+            # Symlinked files are stored as files, as the scan and zip do
+            with tarfile.open(fileobj=sink, mode='w|',
+                              format=tarfile.PAX_FORMAT,
+                              dereference=True) as tar:
+                for name in dirs:
+                    tar.add(os.path.join(from_path, *name.split('/')), name,
+                            recursive=False)
+                for name in files:
+                    path: str = os.path.join(from_path, *name.split('/'))
+                    info: tarfile.TarInfo = tar.gettarinfo(path, name)
+                    with open(path, 'rb') as file:
+                        reader: HashingReader = HashingReader(file)
+                        tar.addfile(info, reader)
+                    stats["digests"][name] = reader.digest.hexdigest()
+            stats["files"] = len(files)
+            sink.close()
+            stats["read"] = sink.read
+    except BaseException:
+        pool.cancel()
+        os.unlink(temp_path)
+        raise
+
+    os.replace(temp_path, archive_path)
+    stats["written"] = os.path.getsize(archive_path)
+    stats["elapsed"] = time.perf_counter() - started
+
+    return stats
+
+
+class ZipWriter:
+    """Zip file writer for entries compressed elsewhere
+
+    Local headers always carry a ZIP64 extra field and are patched with the
+    CRC and sizes once the entry data is written, so entries can be streamed
+    without knowing their compressed size in advance.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.fp = open(path, 'wb')
+        self.entries: list = []
+        self.current: dict = None
+
+        return None
+
+    def start(self, name: str, stat: os.stat_result, method: str) -> None:
+        encoded: bytes = name.encode('utf-8')
+        moment: time.struct_time = time.localtime(stat.st_mtime)
+        if moment.tm_year < 1980:
+            dos_time, dos_date = 0, (1 << 5) | 1
+        else:
+            dos_time = (moment.tm_hour << 11 | moment.tm_min << 5
+                        | moment.tm_sec // 2)
+            dos_date = ((moment.tm_year - 1980) << 9 | moment.tm_mon << 5
+                        | moment.tm_mday)
+        is_dir: bool = name.endswith('/')
+        self.current = {
+            "name": encoded,
+            "method": ZIP_METHODS[method],
+            "time": dos_time,
+            "date": dos_date,
+            "offset": self.fp.tell(),
+            "attributes": (stat.st_mode & 0xFFFF) << 16 | (0x10 if is_dir
+                                                           else 0)
+        }
+        self.fp.write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45, 0x800, self.current["method"],
+            dos_time, dos_date, 0, 0xFFFFFFFF, 0xFFFFFFFF, len(encoded), 20
+        ))
+        self.fp.write(encoded)
+        self.fp.write(struct.pack('<HHQQ', 0x0001, 16, 0, 0))
+        self.current["data_offset"] = self.fp.tell()
+
+        return None
+
+    def write(self, data: bytes) -> None:
+        self.fp.write(data)
+
+        return None
+
+    def finish(self, crc: int, size: int) -> None:
+        entry: dict = self.current
+        end: int = self.fp.tell()
+        entry.update(crc=crc, size=size,
+                     compressed_size=end - entry["data_offset"])
+
+        self.fp.seek(entry["offset"] + 14)
+        self.fp.write(struct.pack('<I', crc))
+        self.fp.seek(entry["data_offset"] - 16)
+        self.fp.write(struct.pack('<QQ', size, entry["compressed_size"]))
+        self.fp.seek(end)
+        self.entries.append(entry)
+        self.current = None
+
+        return None
+
+    def close(self) -> None:
+        directory_offset: int = self.fp.tell()
+        for entry in self.entries:
+            zip64: list = []
+            fields: list = []
+            for key in ('size', 'compressed_size', 'offset'):
+                if entry[key] >= 0xFFFFFFFF:
+                    zip64.append(entry[key])
+                    fields.append(0xFFFFFFFF)
+                else:
+                    fields.append(entry[key])
+            extra: bytes = b''
+            if zip64:
+                extra = struct.pack(f'<HH{len(zip64)}Q', 0x0001,
+                                    8 * len(zip64), *zip64)
+            self.fp.write(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | 45, 45, 0x800,
+                entry["method"], entry["time"], entry["date"], entry["crc"],
+                fields[1], fields[0], len(entry["name"]), len(extra), 0, 0,
+                0, entry["attributes"], fields[2]
+            ))
+            self.fp.write(entry["name"])
+            self.fp.write(extra)
+
+        directory_end: int = self.fp.tell()
+        directory_size: int = directory_end - directory_offset
+        count: int = len(self.entries)
+        if (count >= 0xFFFF or directory_offset >= 0xFFFFFFFF
+                or directory_size >= 0xFFFFFFFF):
+            self.fp.write(struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count,
+                directory_size, directory_offset
+            ))
+            self.fp.write(struct.pack('<IIQI', 0x07064b50, 0, directory_end,
+                                      1))
+            count = min(count, 0xFFFF)
+            directory_size = min(directory_size, 0xFFFFFFFF)
+            directory_offset = min(directory_offset, 0xFFFFFFFF)
+        self.fp.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count,
+                                  directory_size, directory_offset, 0))
+        self.fp.close()
+
+        return None
+
+
+def gf2_matrix_times(matrix: list, vector: int) -> int:
+    result: int = 0
+    row: int = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return result
+
+
+def gf2_matrix_square(matrix: list) -> list:
+    return [gf2_matrix_times(matrix, row) for row in matrix]
+
+
+@functools.lru_cache(maxsize=16)
+def crc32_shift(length: int) -> list:
+    """Returns the matrix appending `length` zero bytes to a CRC-32"""
+    odd: list = [0xEDB88320] + [1 << n for n in range(31)]
+    even: list = gf2_matrix_square(odd)
+    odd = gf2_matrix_square(even)
+    shift: list = [1 << n for n in range(32)]
+
+    while length:
+        even = gf2_matrix_square(odd)
+        if length & 1:
+            shift = [gf2_matrix_times(even, row) for row in shift]
+        length >>= 1
+        if not length:
+            break
+        odd = gf2_matrix_square(even)
+        if length & 1:
+            shift = [gf2_matrix_times(odd, row) for row in shift]
+        length >>= 1
+
+    return shift
+
+
+def crc32_combine(crc1: int, crc2: int, length2: int) -> int:
+    """Returns the CRC-32 of two concatenated pieces from their CRCs
+
+    >>> crc32_combine(zlib.crc32(b'back'), zlib.crc32(b'up'), 2) == zlib.crc32(b'backup')
+    True
+    """
+    if not length2:
+        return crc1
+    return gf2_matrix_times(crc32_shift(length2), crc1) ^ crc2
+
+
+def dedup(from_path: str, to_path: str = os.getcwd(),
+          level: int = 6) -> RunStats:
+    """Backs the tree up into a content-addressed chunk store
+
+    Files unchanged since the latest snapshot (same size and mtime) reuse
+    its chunk lists without being read; only chunks not yet in the store
+    are written.
+    """
+    from_path = os.path.normpath(from_path)
+    to_path = os.path.normpath(to_path)
+    check_paths(from_path, to_path)
+
+    started: float = time.perf_counter()
+    store: ChunkStore = ChunkStore(to_path, level)
+    with stage('scan'):
+        previous: dict = store.latest_snapshot(from_path)
+        old_files: dict = previous["files"] if previous is not None else {}
+        dirs, files = scan_archive_tree(from_path)
+    state: dict = {}
+    read: int = 0
+
+    with stage('chunk'):
+        try:
+            for name, stat in files.items():
+                old: list = old_files.get(name)
+                if old is not None and old[:2] == [stat.st_size,
+                                                   stat.st_mtime_ns]:
+                    state[name] = old
+                    continue
+                chunks: list = []
+                with open(os.path.join(from_path, *name.split('/')),
+                          'rb') as file:
+                    for chunk in iter_chunks(file):
+                        digest: bytes = hashlib.blake2b(
+                            chunk, digest_size=16
+                        ).digest()
+                        store.put(digest, chunk)
+                        chunks.append(digest.hex())
+                        read += len(chunk)
+                state[name] = [stat.st_size, stat.st_mtime_ns, chunks]
+        finally:
+            store.close()
+    with stage('snapshot'):
+        store.write_snapshot(from_path, list(dirs), state)
+
+    elapsed: float = time.perf_counter() - started
+    logger.info(f'Deduplicated from "{from_path}" to "{to_path}" '
+                f'({len(files)} files, {read / 2 ** 20:.1f} MiB read, '
+                f'{store.new_chunks} new chunks, '
+                f'{store.written / 2 ** 20:.1f} MiB written, {elapsed:.2f} s)')
+
+    return RunStats(len(files), read, elapsed, len(files), store.written)
+
+
+def cut_point(data: bytes, start: int, end: int) -> int:
+    """Returns where the chunk starting at `start` ends (FastCDC)
+
+    A gear hash is rolled from CDC_MIN_SIZE on; a stricter mask is used
+    before CDC_AVG_SIZE and a looser one after it, which keeps chunk sizes
+    close to the average.
+    """
+    size: int = end - start
+    if size <= CDC_MIN_SIZE:
+        return end
+    normal: int = start + min(size, CDC_AVG_SIZE)
+    limit: int = start + min(size, CDC_MAX_SIZE)
+    gear: tuple = GEAR
+    fingerprint: int = 0
+
+    for i in range(start + CDC_MIN_SIZE, normal):
+        fingerprint = ((fingerprint << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        if not fingerprint & CDC_MASK_STRICT:
+            return i + 1
+    for i in range(normal, limit):
+        fingerprint = ((fingerprint << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        if not fingerprint & CDC_MASK_LOOSE:
+            return i + 1
+
+    return limit
+
+
+def iter_chunks(file):
+    """Yields content-defined chunks of a binary file"""
+    buffer: bytes = b''
+    eof: bool = False
+
+    while True:
+        if not eof and len(buffer) < CDC_MAX_SIZE:
+            data: bytes = file.read(CDC_READ_SIZE)
+            eof = not data
+            buffer += data
+            continue
+        if not buffer:
+            return None
+        position: int = 0
+        while len(buffer) - position >= CDC_MAX_SIZE or (
+                eof and position < len(buffer)):
+            end: int = cut_point(buffer, position, len(buffer))
+            yield buffer[position:end]
+            position = end
+        buffer = buffer[position:]
+        if eof and not buffer:
+            return None
+
+
+class ChunkStore:
+    """Content-addressed store of deduplicated chunks
+
+    Chunks are keyed by their BLAKE2b digest, zlib-compressed and appended
+    to pack files. The index file holds one fixed-size record per chunk
+    (digest, pack, offset, length); snapshots list the chunks of every file.
+    The store is locked from opening to close, as two runs appending to the
+    same pack and index would corrupt them.
+    """
+
+    def __init__(self, path: str, level: int = 6) -> None:
+        self.path: str = path
+        self.level: int = level
+        self.index: dict = {}
+        self.records: list = []
+        self.readers: dict = {}
+        self.pack_fp = None
+        self.pack_id: int = 0
+        self.new_chunks: int = 0
+        self.written: int = 0
+
+        for directory in ('packs', 'snapshots'):
+            os.makedirs(os.path.join(path, directory), exist_ok=True)
+        self.lock_fp = open(os.path.join(path, 'lock'), 'ab')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f'Chunk store "{path}" in use, waiting for it')
+                fcntl.flock(self.lock_fp, fcntl.LOCK_EX)
+        index_path: str = os.path.join(path, 'index')
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as index_fp:
+                data: bytes = index_fp.read()
+            usable: int = len(data) - len(data) % CHUNK_RECORD.size
+            for digest, pack_id, offset, length in CHUNK_RECORD.iter_unpack(
+                    data[:usable]):
+                self.index[digest] = (pack_id, offset, length)
+                self.pack_id = max(self.pack_id, pack_id)
+        logger.debug(f'Chunk store "{path}" opened ({len(self.index)} chunks)')
+
+        return None
+
+    def pack_path(self, pack_id: int) -> str:
+        return os.path.join(self.path, 'packs', f'{pack_id:08d}.pack')
+
+    def put(self, digest: bytes, data: bytes) -> bool:
+        if digest in self.index:
+            return False
+
+        compressed: bytes = zlib.compress(data, self.level)
+        payload: bytes = (b'z' + compressed if len(compressed) < len(data)
+                          else b's' + data)
+        if self.pack_fp is None and self.pack_id:
+            self.pack_fp = open(self.pack_path(self.pack_id), 'ab')
+        if self.pack_fp is None or self.pack_fp.tell() >= PACK_SIZE:
+            if self.pack_fp is not None:
+                self.pack_fp.close()
+            self.pack_id += 1
+            self.pack_fp = open(self.pack_path(self.pack_id), 'ab')
+        offset: int = self.pack_fp.tell()
+        self.pack_fp.write(payload)
+
+        self.index[digest] = (self.pack_id, offset, len(payload))
+        self.records.append(CHUNK_RECORD.pack(digest, self.pack_id, offset,
+                                              len(payload)))
+        self.new_chunks += 1
+        self.written += len(payload)
+
+        return True
+
+    def get(self, digest: bytes) -> bytes:
+        pack_id, offset, length = self.index[digest]
+        if pack_id not in self.readers:
+            self.readers[pack_id] = open(self.pack_path(pack_id), 'rb')
+        reader = self.readers[pack_id]
+        reader.seek(offset)
+        payload: bytes = reader.read(length)
+
+        return zlib.decompress(payload[1:]) if payload[:1] == b'z' \
+            else payload[1:]
+
+    def close(self) -> None:
+        """Makes new chunks durable, records them in the index, then unlocks
+        the store"""
+        if self.pack_fp is not None:
+            self.pack_fp.flush()
+            os.fsync(self.pack_fp.fileno())
+            self.pack_fp.close()
+            self.pack_fp = None
+        if self.records:
+            with open(os.path.join(self.path, 'index'), 'ab') as index_fp:
+                index_fp.write(b''.join(self.records))
+                index_fp.flush()
+                os.fsync(index_fp.fileno())
+            self.records = []
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+        if self.lock_fp is not None:
+            self.lock_fp.close()
+            self.lock_fp = None
+
+        return None
+
+    def snapshots(self) -> dict:
+        return load_snapshots(self.path)
+
+    def latest_snapshot(self, from_path: str) -> dict:
+        return latest_snapshot(self.path, from_path)
+
+    def write_snapshot(self, from_path: str, dirs: list,
+                       files: dict) -> None:
+        snapshot: dict = {
+            "source": os.path.abspath(from_path),
+            "created": time.time(),
+            "dirs": dirs,
+            "files": files
+        }
+        path: str = os.path.join(self.path, 'snapshots',
+                                 time.strftime('%d.%m.%y_%H-%M-%S')
+                                 + '.json.gz')
+        write_atomic(path, gzip.compress(
+            json.dumps(snapshot, separators=(',', ':')).encode()
+        ))
+
+        return None
+
+
+def load_snapshots(store_path: str) -> dict:
+    """Loads every snapshot of a chunk store by file name, read-only"""
+    snapshots: dict = {}
+    directory: str = os.path.join(store_path, 'snapshots')
+    if not os.path.isdir(directory):
+        return snapshots
+    for filename in os.listdir(directory):
+        try:
+            with gzip.open(os.path.join(directory, filename), 'rt') as file:
+                snapshots[filename] = json.load(file)
+        except (OSError, ValueError):
+            logger.warning(f'Snapshot "{filename}" is corrupted, ignored')
+
+    return snapshots
+
+
+def latest_snapshot(store_path: str, from_path: str) -> dict:
+    source: str = os.path.abspath(from_path)
+    return max((snapshot for snapshot in load_snapshots(store_path).values()
+                if snapshot["source"] == source),
+               key=lambda snapshot: snapshot["created"], default=None)
+
+
+def restore_dedup(store_path: str, target: str, point: str = None) -> None:
+    snapshots: dict = load_snapshots(store_path)
+    names: list = sorted(snapshots, key=lambda name: snapshots[name]["created"])
+    if point is not None:
+        names = [name for name in names if name.startswith(point)]
+    if not names:
+        logger.critical(f'No snapshot found in "{store_path}"')
+        raise FileNotFoundError(f'No snapshot found in "{store_path}"')
+
+    snapshot: dict = snapshots[names[-1]]
+    store: ChunkStore = ChunkStore(store_path)
+    try:
+        for name in snapshot["dirs"]:
+            os.makedirs(os.path.join(target, *name.split('/')),
+                        exist_ok=True)
+        for name, (size, mtime_ns, chunks) in snapshot["files"].items():
+            path: str = os.path.join(target, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                for digest in chunks:
+                    file.write(store.get(bytes.fromhex(digest)))
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+    finally:
+        store.close()
+
+    logger.info(f'Restored snapshot "{names[-1]}" '
+                f'({len(snapshot["files"])} files) to "{target}"')
+
+    return None
+
+
+class ChunkedHash:
+    """BLAKE2b of the BLAKE2b digests of HASH_CHUNK_SIZE pieces
+
+    Pieces can be hashed separately (in worker processes or threads) and
+    combined in order, so hashing never needs its own pass over the data.
+    """
+
+    def __init__(self) -> None:
+        self.digests: list = []
+        self.buffer: bytearray = bytearray()
+
+        return None
+
+    def update(self, data: bytes) -> None:
+        """Adds stream data; pieces are cut at HASH_CHUNK_SIZE"""
+        if not self.buffer and len(data) == HASH_CHUNK_SIZE:
+            self.add_piece(chunk_digest(data))
+            return None
+        self.buffer += data
+        while len(self.buffer) >= HASH_CHUNK_SIZE:
+            self.add_piece(chunk_digest(self.buffer[:HASH_CHUNK_SIZE]))
+            del self.buffer[:HASH_CHUNK_SIZE]
+
+        return None
+
+    def add_piece(self, digest: bytes) -> None:
+        self.digests.append(digest)
+
+        return None
+
+    def hexdigest(self) -> str:
+        digests: list = list(self.digests)
+        if self.buffer or not digests:
+            digests.append(chunk_digest(self.buffer))
+        return hashlib.blake2b(b''.join(digests), digest_size=16).hexdigest()
+
+
+def chunk_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def hash_file(file) -> str:
+    """Returns the ChunkedHash digest of the rest of a binary file object
+
+    >>> import io
+    >>> digest = ChunkedHash()
+    >>> digest.update(b'back')
+    >>> digest.update(b'up')
+    >>> hash_file(io.BytesIO(b'backup')) == digest.hexdigest()
+    True
+    """
+    digest: ChunkedHash = ChunkedHash()
+    while chunk := file.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def load_manifests(archive_dir: str) -> dict:
+    """Loads every archive manifest in the directory by archive name"""
+    manifests: dict = {}
+    for filename in os.listdir(archive_dir):
+        if not filename.endswith(MANIFEST_SUFFIX):
+            continue
+        try:
+            with gzip.open(os.path.join(archive_dir, filename), 'rt') as file:
+                manifest: dict = json.load(file)
+        except (OSError, ValueError):
+            logger.warning(f'Manifest "{filename}" is corrupted, ignored')
+            continue
+        manifests[manifest["archive"]] = manifest
+
+    return manifests
+
+
+def latest_manifest(archive_dir: str, from_path: str) -> dict:
+    source: str = os.path.abspath(from_path)
+    manifests: list = [manifest
+                       for manifest in load_manifests(archive_dir).values()
+                       if manifest["source"] == source]
+
+    return max(manifests, key=lambda manifest: manifest["created"],
+               default=None)
+
+
+def write_manifest(archive_path: str, from_path: str, dirs: dict,
+                   tree_files: dict, files: dict, digests: dict,
+                   previous: dict = None) -> None:
+    """Writes the archive manifest: tree state, included and deleted files
+
+    Digests of included files come from the archive writer, which hashes
+    data as it reads it. Other files keep the previous manifest's record.
+    """
+    old_files: dict = previous["files"] if previous is not None else {}
+    state: dict = {}
+    for name, stat in tree_files.items():
+        if name in files:
+            state[name] = [stat.st_size, stat.st_mtime_ns, digests[name]]
+        else:
+            state[name] = old_files[name]
+    deleted: list = [name for name in old_files if name not in tree_files]
+
+    manifest: dict = {
+        "archive": os.path.basename(archive_path),
+        "source": os.path.abspath(from_path),
+        "created": time.time(),
+        "base": previous["archive"] if previous is not None else None,
+        "depth": previous["depth"] + 1 if previous is not None else 0,
+        "dirs": list(dirs),
+        "files": state,
+        "included": list(files),
+        "deleted": deleted
+    }
+    with gzip.open(archive_path + MANIFEST_SUFFIX, 'wt') as file:
+        json.dump(manifest, file, separators=(',', ':'))
+    logger.debug(f'Manifest of "{archive_path}" written '
+                 f'({len(files)} included, {len(deleted)} deleted)')
+
+    return None
+
+
+def open_archive(archive_path: str):
+    """Yields (name, file object) for every file of an archive"""
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive_file:
+            for info in archive_file.infolist():
+                if not info.is_dir():
+                    with archive_file.open(info) as member:
+                        yield info.filename, member
+        return None
+
+    with open(archive_path, 'rb') as raw:
+        if archive_path.endswith('.tar.zst'):
+            if zstd.__name__ == 'zstandard':
+                stream = zstd.ZstdDecompressor().stream_reader(
+                    raw, read_across_frames=True
+                )
+            else:
+                stream = zstd.ZstdFile(raw)
+        elif archive_path.endswith('.tar.gz'):
+            stream = gzip.GzipFile(fileobj=raw)
+        else:
+            stream = lzma.LZMAFile(raw)
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member)
+
+    return None
+
+
+def verify_archives(archive_dir: str) -> bool:
+    """Checks archives against the digests recorded in their manifests"""
+    check_paths(archive_dir)
+    corrupted: int = 0
+    checked: int = 0
+
+    for archive_name, manifest in load_manifests(archive_dir).items():
+        expected: set = set(manifest["included"])
+        try:
+            for name, member in open_archive(os.path.join(archive_dir,
+                                                          archive_name)):
+                if name not in expected:
+                    continue
+                expected.discard(name)
+                checked += 1
+                if hash_file(member) != manifest["files"][name][2]:
+                    corrupted += 1
+                    logger.error(f'"{name}" in "{archive_name}" is corrupted')
+        except (OSError, EOFError, zlib.error, tarfile.TarError,
+                zipfile.BadZipFile, lzma.LZMAError) as error:
+            corrupted += 1
+            logger.error(f'"{archive_name}" is unreadable: {error}')
+            continue
+        for name in expected:
+            corrupted += 1
+            logger.error(f'"{name}" is missing from "{archive_name}"')
+
+    logger.info(f'Verified {checked} files in "{archive_dir}", '
+                f'{corrupted} problems')
+
+    return not corrupted
+
+
+def restore(archive_dir: str, target: str, point: str = None) -> None:
+    """Restores a tree as of an archive from its base and increments
+
+    `point` is the beginning of an archive name ("%d.%m.%y_%H-%M-%S"),
+    the latest archive is used by default. Chunk store directories are
+    restored from their snapshots instead.
+    """
+    check_paths(archive_dir)
+    if os.path.isdir(os.path.join(archive_dir, 'snapshots')):
+        return restore_dedup(archive_dir, target, point)
+    manifests: dict = load_manifests(archive_dir)
+    names: list = sorted(manifests, key=lambda name: manifests[name]["created"])
+    if point is not None:
+        names = [name for name in names if name.startswith(point)]
+    if not names:
+        logger.critical(f'No archive manifest found in "{archive_dir}"')
+        raise FileNotFoundError(f'No archive manifest found in "{archive_dir}"')
+
+    manifest: dict = manifests[names[-1]]
+    chain: list = [manifest]
+    while chain[-1]["base"] is not None:
+        if chain[-1]["base"] not in manifests:
+            logger.critical(f'Base archive "{chain[-1]["base"]}" is missing')
+            raise FileNotFoundError(chain[-1]["base"])
+        chain.append(manifests[chain[-1]["base"]])
+
+    sources: dict = {}
+    for link in chain:
+        for name in link["included"]:
+            if name in manifest["files"]:
+                sources.setdefault(name, link["archive"])
+
+    for name in manifest["dirs"]:
+        os.makedirs(os.path.join(target, *name.split('/')), exist_ok=True)
+    for archive_name in set(sources.values()):
+        for name, member in open_archive(os.path.join(archive_dir,
+                                                      archive_name)):
+            if sources.get(name) != archive_name:
+                continue
+            path: str = os.path.join(target, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                shutil.copyfileobj(member, file, COPY_BUFFER_SIZE)
+            mtime_ns: int = manifest["files"][name][1]
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    logger.info(f'Restored "{manifest["archive"]}" ({len(chain) - 1} '
+                f'increments, {len(sources)} files) to "{target}"')
+
+    return None
+
+
+def check_paths(*paths) -> None:
+    for path_ in paths:
+        if not os.path.exists(path_):
+            logger.critical(f'No such directory: {repr(path_)}')
+            raise FileNotFoundError(f'No such directory: {repr(path_)}')
+
+    return None
+
+
+def plan_config(config: Config) -> dict:
+    """Dry-runs every action of the config: scan and diff, nothing written
+
+    Estimated times come from the throughput recorded by past runs.
+    """
+    return {
+        "generated": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "actions": [plan_action(action) for action in config.actions]
+    }
+
+
+def plan_action(action: ActionConfig) -> dict:
+    started: float = time.perf_counter()
+    plan: dict = {"name": action.name, "type": action.type}
+    try:
+        if action.type == 'sync':
+            plan.update(sync_plan(**action.setup))
+        elif action.type == 'dedup':
+            plan.update(dedup_plan(**action.setup))
+        else:
+            plan.update(archive_plan(**action.setup))
+    except (OSError, ValueError) as error:
+        plan["error"] = str(error)
+        return plan
+
+    throughput: float = (done_store.get_run(action.name)
+                         or {}).get("bytes_per_second")
+    plan["bytes_per_second"] = throughput
+    plan["estimated_seconds"] = (round(plan["bytes"] / throughput, 1)
+                                 if throughput else None)
+    plan["planned_in"] = round(time.perf_counter() - started, 3)
+
+    return plan
+
+
+def sync_plan(paths_to_sync: list, full_rescan_hours: float = 24,
+              deletions: bool = False,
+              max_deleted_share: float = MAX_DELETED_SHARE,
+              **options) -> dict:
+    """Counts what sync would do, from the same walk and plan as a run
+
+    The walk is a full scan when the run would do one.
+    "deletes_refused" tells why the run would not delete, if it would not.
+    """
+    check_paths(*paths_to_sync)
+    index: SyncIndex = SyncIndex(paths_to_sync)
+    full_scan: bool = index.scanned + full_rescan_hours * 3600 <= time.time()
+    seen: dict = (dict((top, index.tree(top)) for top in index.tops)
+                  if deletions else None)
+    plan: dict = {"files": 0, "bytes": 0, "dirs": 0, "deletes": 0,
+                  "deletes_refused": None, "full_scan": full_scan}
+    deletes: list = []
+    for op in plan_sync(walk_trees(index.tops, index, full_scan), seen):
+        if op.action == 'copy':
+            plan["files"] += len(op.dst_tops)
+            plan["bytes"] += op.entry.size * len(op.dst_tops)
+        elif op.action == 'mkdir':
+            plan["dirs"] += len(op.dst_tops)
+        elif op.action == 'delete':
+            plan["deletes"] += len(op.dst_tops)
+            deletes.append(op)
+    if deletes:
+        plan["deletes_refused"] = deletions_refused(deletes, index, seen,
+                                                    max_deleted_share)
+        if plan["deletes_refused"] is not None:
+            plan["deletes"] = 0
+
+    return plan
+
+
+def archive_plan(from_path: str, to_path: str = os.getcwd(),
+                 incremental: bool = False, full_every: int = 7,
+                 **options) -> dict:
+    from_path = os.path.normpath(from_path)
+    to_path = os.path.normpath(to_path)
+    check_paths(from_path, to_path)
+    dirs, _, files, previous = select_archive_files(from_path, to_path,
+                                                    incremental, full_every)
+
+    return {
+        "files": len(files),
+        "bytes": sum(stat.st_size for stat in files.values()),
+        "dirs": len(dirs),
+        "incremental": previous is not None
+    }
+
+
+def dedup_plan(from_path: str, to_path: str = os.getcwd(),
+               **options) -> dict:
+    """Counts the files dedup would read: those changed since the snapshot"""
+    from_path = os.path.normpath(from_path)
+    to_path = os.path.normpath(to_path)
+    check_paths(from_path, to_path)
+    previous: dict = latest_snapshot(to_path, from_path)
+    old_files: dict = previous["files"] if previous is not None else {}
+    dirs, files = scan_archive_tree(from_path)
+    changed: list = [stat for name, stat in files.items()
+                     if old_files.get(name, [None, None])[:2]
+                     != [stat.st_size, stat.st_mtime_ns]]
+
+    return {
+        "files": len(changed),
+        "bytes": sum(stat.st_size for stat in changed),
+        "dirs": len(dirs)
+    }
+
+
 if __name__ == '__main__':
-    logger: logging.Logger = logging.getLogger(__name__)
     setup_logger(logger)
+    profile_runs = '--profile' in sys.argv
 
     if '0' in sys.argv:
         sys.argv.append('-v')
@@ -367,7 +4205,20 @@ if __name__ == '__main__':
         del doctest
 
     try:
-        main()
+        if '--restore' in sys.argv:
+            restore(*sys.argv[sys.argv.index('--restore') + 1:])
+        elif '--verify' in sys.argv:
+            verify_archives(*sys.argv[sys.argv.index('--verify') + 1:])
+        elif '--plan' in sys.argv:
+            plan_text: str = json.dumps(plan_config(load_config('config.json')),
+                                        indent=2)
+            plan_args: list = sys.argv[sys.argv.index('--plan') + 1:]
+            if plan_args:
+                write_atomic(plan_args[0], plan_text.encode())
+            else:
+                print(plan_text)
+        else:
+            main()
     except:
         logger.critical('CRITICAL ERROR!',
                         exc_info=sys.exc_info())